@@ -0,0 +1,169 @@
+import hashlib
+import os
+import tempfile
+import time
+
+import numpy as np
+
+# Version of the layout of cached entries; part of every key, so entries
+# written in an older layout are never read back
+CACHE_FORMAT = 1
+
+def hash_file(filename, chunk_size=1<<20):
+    """
+    Return the SHA-256 digest of the contents of a file (including headers).
+    """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hash_template(template):
+    """
+    Return the SHA-256 digest of a template. Works for Profile and Portrait
+    objects (via their Stokes parameters) and for SplineModel objects
+    (via their mean profile, eigenvectors, and spline representation).
+    """
+    h = hashlib.sha256()
+    h.update(type(template).__name__.encode())
+    if hasattr(template, 'tck'):
+        t, c, k = template.tck
+        arrays = [template.mean_prof, template.eigvec, t, *c, k]
+    elif template.full_stokes:
+        arrays = [template.I, template.Q, template.U, template.V]
+    else:
+        arrays = [template.I]
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str((arr.dtype.str, arr.shape)).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+class ToaCache:
+    def __init__(self, directory, max_bytes=1<<30):
+        """
+        Create an on-disk cache of TOA results, stored as `.npz` files in
+        `directory`. Entries are content-addressed, so they remain valid
+        across runs as long as the inputs are unchanged. When the total size
+        of the cache exceeds `max_bytes`, the least recently used entries
+        are removed.
+
+        The cache may be shared between processes: entries are written to
+        temporary files and atomically renamed into place, and entries that
+        disappear due to concurrent eviction are treated as misses. The
+        directory is scanned once, on the first insertion; after that, each
+        process keeps a running total of the cache size and scans again
+        only when the total exceeds `max_bytes` (so with several writers,
+        the limit may be exceeded until one of them scans).
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, filename, template, **params):
+        """
+        Compute the cache key for a data file, a template, and a set of
+        keyword parameters affecting the result. The key also depends on
+        `CACHE_FORMAT`, which must be increased whenever the layout of
+        cached entries changes.
+        """
+        h = hashlib.sha256()
+        h.update(f"chroniton-toa-cache-{CACHE_FORMAT}".encode())
+        h.update(hash_file(filename).encode())
+        h.update(hash_template(template).encode())
+        h.update(repr(sorted(params.items())).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.npz")
+
+    def get(self, key):
+        """
+        Return the dictionary of arrays stored under `key`, or `None` if
+        there is no such entry.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                result = {name: f[name] for name in f.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # Unreadable entry -- discard it and recompute
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return result
+
+    def put(self, key, **arrays):
+        """
+        Store a set of arrays under `key`, then evict old entries if the
+        cache has grown beyond its size limit.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        if self._size is None:
+            self.evict()
+            return
+        try:
+            self._size += os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        if self._size > self.max_bytes:
+            # Leave some headroom, so that the next insertions don't each
+            # trigger another scan
+            self.evict(target_bytes=int(0.9*self.max_bytes))
+
+    def evict(self, stale_tmp_age=3600, target_bytes=None):
+        """
+        Remove least recently used entries until the cache fits within
+        `target_bytes` (by default, `max_bytes`). Temporary files older
+        than `stale_tmp_age` seconds, left behind by crashed writers, are
+        also removed.
+        """
+        if target_bytes is None:
+            target_bytes = self.max_bytes
+        entries = []
+        total = 0
+        now = time.time()
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith('.tmp'):
+                    if now - st.st_mtime > stale_tmp_age:
+                        self._remove(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= target_bytes:
+                break
+            self._remove(path)
+            total -= size
+        self._size = total
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,116 @@
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from astropy.io import fits
+
+from .profile import Profile
+from .observation import Observation
+from .pipeline import prefetch, observation_toa_table
+from .toa_table import ToaTable
+from .cache import ToaCache
+
+def expand_globs(patterns):
+    """
+    Expand shell-style glob patterns lazily, in order. Patterns that do not
+    match any files are passed through unchanged, so that missing files are
+    reported rather than silently skipped.
+    """
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if matches:
+            yield from matches
+        else:
+            yield pattern
+
+def file_toa_table(template, template_name, filename, cache=None):
+    """
+    Calculate TOAs for every subintegration and channel of a PSRFITS file.
+    Returns a tuple `(table, error)`, where `table` is a ToaTable and
+    `error` is a message describing why the file could not be processed
+    (or `None` if it was processed successfully). Errors of any kind are
+    reported this way, so that one bad file does not stop a batch.
+    If a ToaCache is supplied, results for unchanged inputs are reused.
+    """
+    try:
+        if cache is not None:
+            key = cache.key(filename, template, template_name=template_name,
+                            name=os.path.basename(filename))
+            cached = cache.get(key)
+            if cached is not None:
+                return ToaTable.from_arrays(cached), None
+        header = fits.getheader(filename, 'PRIMARY')
+        obs = Observation.from_file(filename)
+        frontend = header.get('FRONTEND', 'unknown')
+        backend = header.get('BACKEND', 'unknown')
+        file_flags = {
+            'fe': frontend,
+            'be': backend,
+            'f': f"{frontend}_{backend}",
+            'nch': obs.shape[1],
+            'tmplt': template_name,
+        }
+        table = observation_toa_table(
+            template,
+            obs,
+            filename=os.path.basename(filename),
+            site=header.get('TELESCOP', 'unknown').lower().replace(' ', ''),
+            file_flags=file_flags,
+        )
+    except Exception as e:
+        # Any failure (unreadable file, failed fit, ...) only skips this file
+        return None, f"{filename}: {type(e).__name__}: {e}"
+
+    if cache is not None:
+        cache.put(key, **table.to_arrays())
+    return table, None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='chroniton-toas',
+        description="Calculate TOAs for a set of PSRFITS archives and write a tempo2-format .tim file.",
+    )
+    parser.add_argument('template', help="PSRFITS file containing the template profile")
+    parser.add_argument('archives', nargs='+', help="PSRFITS files or glob patterns to process")
+    parser.add_argument('-o', '--output', default='-', help="Output .tim file (default: stdout)")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--depth', type=int, default=None,
+                        help="Maximum number of files in flight at once (default: twice the number of jobs)")
+    parser.add_argument('--cache', default=None,
+                        help="Directory in which to cache TOA results between runs (default: no cache)")
+    parser.add_argument('--cache-size', type=float, default=1024,
+                        help="Maximum size of the TOA cache, in MB (default: 1024)")
+    args = parser.parse_args(argv)
+
+    template = Profile.from_file(args.template)
+    template_name = os.path.basename(args.template)
+    depth = args.depth if args.depth is not None else 2*args.jobs
+    cache = None
+    if args.cache is not None:
+        cache = ToaCache(args.cache, max_bytes=int(args.cache_size*2**20))
+    worker = partial(file_toa_table, template, template_name, cache=cache)
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    n_failed = 0
+    try:
+        out.write("FORMAT 1\n")
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = prefetch(worker, expand_globs(args.archives), depth=depth, executor=executor)
+            for filename, (table, error) in results:
+                if error is not None:
+                    print(f"Skipping {error}", file=sys.stderr)
+                    n_failed += 1
+                    continue
+                table.write_tim(out, header=False)
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if n_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
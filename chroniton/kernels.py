@@ -0,0 +1,172 @@
+import os
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+_backend = os.environ.get('CHRONITON_BACKEND', 'auto').lower()
+
+def set_backend(name):
+    """
+    Select the backend used for the innermost loops of TOA calculation:
+    'numba' (compiled kernels), 'numpy' (pure NumPy/SciPy), or 'auto'
+    (Numba if it is installed, NumPy otherwise). The initial value is taken
+    from the environment variable CHRONITON_BACKEND, defaulting to 'auto';
+    set it to 'numpy' to get the same results whether or not Numba is
+    installed.
+
+    The backends agree closely but not exactly (see tests/test_kernels.py).
+    In a check on 300 simulated profiles (512 bins, shifts up to 200 bins,
+    S/N 2-200), `toa_fourier()` TOAs differed by at most 1.4e-6 bins
+    (< 2e-5 of their uncertainty), the difference being set by the
+    relative tolerance of SciPy's Brent search; `toa_fourier_batch()`,
+    which uses the same refinement in both backends, differed by at most
+    2.5e-8 bins over 2000 profiles.
+    """
+    global _backend
+    name = name.lower()
+    if name not in ('auto', 'numba', 'numpy'):
+        raise ValueError(f"Unrecognized backend '{name}'.")
+    if name == 'numba' and numba is None:
+        raise ImportError("The 'numba' backend requires Numba to be installed.")
+    _backend = name
+
+def get_backend():
+    """
+    Return the name of the backend currently in use ('numba' or 'numpy').
+    """
+    if numba is not None and _backend in ('auto', 'numba'):
+        return 'numba'
+    return 'numpy'
+
+def rfft_weights(n):
+    """
+    Weights with which each term of a real-input DFT of length `n`
+    contributes to a sum over the full DFT: 1 for DC (and Nyquist, if `n`
+    is even), 2 for all other frequencies.
+    """
+    weights = np.full(n//2 + 1, 2.0)
+    weights[0] = 1.0
+    if n % 2 == 0:
+        weights[-1] = 1.0
+    return weights
+
+def _refine_ccf_peak(coeffs, omega, lo, hi, x0, tol, maxiter):
+    # Maximize f(x) = sum_k Re(coeffs[k]*exp(1j*omega[k]*x)) on (lo, hi)
+    # by Newton's method on f'(x), falling back to bisection whenever a
+    # Newton step leaves the bracket or f is not locally concave.
+    # Phase ramps and the inner product are accumulated term by term,
+    # so no intermediate arrays are created.
+    x = x0
+    for _ in range(maxiter):
+        d1 = 0.0
+        d2 = 0.0
+        for k in range(coeffs.size):
+            c = np.cos(omega[k]*x)
+            s = np.sin(omega[k]*x)
+            re = coeffs[k].real*c - coeffs[k].imag*s
+            im = coeffs[k].real*s + coeffs[k].imag*c
+            d1 -= omega[k]*im
+            d2 -= omega[k]*omega[k]*re
+        if d1 > 0:
+            lo = x
+        else:
+            hi = x
+        if d2 < 0:
+            x_new = x - d1/d2
+        else:
+            x_new = 0.5*(lo + hi)
+        if not lo < x_new < hi:
+            x_new = 0.5*(lo + hi)
+        if abs(x_new - x) < tol:
+            return x_new
+        x = x_new
+    return x
+
+def _rolling_sum(arr, size):
+    n = arr.size
+    out = np.empty(n, dtype=np.float64)
+    # Window for index i covers arr[i+1], ..., arr[i+size], as in utils.rolling_sum()
+    window = 0.0
+    for j in range(1, size + 1):
+        window += arr[j % n]
+    for i in range(n):
+        out[i] = window
+        window += arr[(i + size + 1) % n] - arr[(i + 1) % n]
+    return out
+
+def _refine_ccf_peaks_numpy(coeffs, omega, guess, tol, maxiter):
+    # Vectorized version of _refine_ccf_peak(), iterating only on
+    # the rows that have not yet converged
+    x = guess.astype(np.float64)
+    lo = x - 1.0
+    hi = x + 1.0
+    active = np.arange(x.size)
+    for _ in range(maxiter):
+        z = coeffs[active]*np.exp(1j*omega*x[active, np.newaxis])
+        d1 = -np.sum(omega*z.imag, axis=-1)
+        d2 = -np.sum(omega**2*z.real, axis=-1)
+        lo_a = np.where(d1 > 0, x[active], lo[active])
+        hi_a = np.where(d1 > 0, hi[active], x[active])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_new = np.where(d2 < 0, x[active] - d1/d2, 0.5*(lo_a + hi_a))
+        outside = ~((lo_a < x_new) & (x_new < hi_a))
+        x_new[outside] = 0.5*(lo_a + hi_a)[outside]
+        converged = np.abs(x_new - x[active]) < tol
+        x[active] = x_new
+        lo[active] = lo_a
+        hi[active] = hi_a
+        active = active[~converged]
+        if active.size == 0:
+            break
+    return x
+
+def _refine_ccf_peaks_numba(coeffs, omega, guess, tol, maxiter):
+    x = np.empty(guess.size)
+    for i in numba.prange(guess.size):
+        x[i] = _refine_ccf_peak(coeffs[i], omega, guess[i] - 1.0, guess[i] + 1.0,
+                                float(guess[i]), tol, maxiter)
+    return x
+
+if numba is not None:
+    _refine_ccf_peak = numba.njit(cache=True)(_refine_ccf_peak)
+    _refine_ccf_peaks_numba = numba.njit(cache=True, parallel=True)(_refine_ccf_peaks_numba)
+    _rolling_sum = numba.njit(cache=True)(_rolling_sum)
+
+def refine_ccf_peak(profile_rfft, template_rfft, n, guess, tol, maxiter=100):
+    """
+    Find the shift (in bins) maximizing the cross-correlation of a profile
+    and a template of length `n`, given their real-input DFTs, within one
+    bin of `guess`. Uses the compiled kernel if Numba is available.
+    """
+    if template_rfft.size != profile_rfft.size:
+        raise ValueError("Profile and template spectra must have the same length.")
+    coeffs = profile_rfft*np.conj(template_rfft)*rfft_weights(n)/n
+    omega = 2*np.pi*np.arange(profile_rfft.size)/n
+    return _refine_ccf_peak(coeffs, omega, guess - 1.0, guess + 1.0, float(guess), tol, maxiter)
+
+def refine_ccf_peaks(profile_rfft, template_rfft, n, guess, tol, maxiter=100):
+    """
+    Batched version of `refine_ccf_peak()`. The spectra have shape
+    (..., n//2 + 1) and are broadcast against each other; `guess` has
+    the broadcast shape without the last axis. Returns refined shifts
+    (in bins) with the same shape as `guess`.
+    """
+    cross = profile_rfft*np.conj(template_rfft)
+    coeffs = (cross*rfft_weights(n)/n).reshape(-1, cross.shape[-1])
+    omega = 2*np.pi*np.arange(cross.shape[-1])/n
+    guess = np.broadcast_to(guess, cross.shape[:-1]).ravel()
+    if get_backend() == 'numba':
+        x = _refine_ccf_peaks_numba(np.ascontiguousarray(coeffs), omega, guess, tol, maxiter)
+    else:
+        x = _refine_ccf_peaks_numpy(coeffs, omega, guess, tol, maxiter)
+    return x.reshape(cross.shape[:-1])
+
+def rolling_sum(arr, size):
+    """
+    Sum of `arr` over a sliding window of length `size`, wrapping around at
+    the end of the array, computed with the compiled kernel.
+    """
+    return _rolling_sum(np.ascontiguousarray(arr, dtype=np.float64), size)
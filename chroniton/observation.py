@@ -4,21 +4,75 @@ import matplotlib.pyplot as plt
 import scipy.signal
 from astropy.io import fits
 import astropy.units as u
-from astropy.time import Time
 from pint import PulsarMJD
 
-from .utils import fft_roll
-from .polarization import validate_stokes, coherence_to_stokes
+from .utils import fft_roll, is_lazy
+from .polarization import validate_stokes, coherence_to_stokes, PolarizationCache
 from .portrait import Portrait
+from .spectra import SpectrumCache, StokesOperations
+from .psrfits import start_time_from_header
 
-class Observation:
-    def __init__(self, epochs, freq, I, Q=None, U=None, V=None):
+def decode_subints(subint_data, weights, dtype):
+    """
+    Decode the DATA column of (some rows of) a PSRFITS SUBINT table,
+    applying DAT_SCL and DAT_OFFS. Only profiles with nonzero weight are
+    decoded; zapped profiles are left as zeros.
+    Returns an array of shape (nsub, npol, nchan, nbin).
+    """
+    data = subint_data['DATA']
+    nsub, npol, nchan, nbin = data.shape
+    newshape = (nsub, npol, nchan, 1)
+    scale = subint_data['DAT_SCL'].reshape(newshape)
+    offset = subint_data['DAT_OFFS'].reshape(newshape)
+
+    isub, ichan = np.nonzero(weights)
+    decoded = np.zeros(data.shape, dtype=dtype)
+    rows = data[isub, :, ichan].astype(dtype)
+    rows *= scale[isub, :, ichan].astype(dtype)
+    rows += offset[isub, :, ichan].astype(dtype)
+    decoded[isub, :, ichan] = rows
+    return decoded
+
+class LazyPsrfitsData:
+    def __init__(self, filename, shape, dtype):
+        """
+        Array-like view of the decoded data in a PSRFITS file, of shape
+        (nsub, npol, nchan, nbin), which reads and decodes only the
+        subintegrations that are requested. Used to build dask arrays.
+        """
+        self.filename = filename
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(shape)
+
+    def __getitem__(self, key):
+        # Only basic slicing along the subintegration axis is supported,
+        # which is all that dask needs.
+        if not isinstance(key, tuple):
+            key = (key,)
+        with fits.open(self.filename) as hdul:
+            subint_data = hdul['SUBINT'].data[key[0]]
+            nsub = len(subint_data)
+            if 'DAT_WTS' in subint_data.columns.names:
+                weights = np.array(subint_data['DAT_WTS']).reshape(nsub, self.shape[2])
+            else:
+                weights = np.ones((nsub, self.shape[2]))
+            decoded = decode_subints(subint_data, weights, self.dtype)
+        return decoded[(slice(None),) + key[1:]]
+
+class Observation(SpectrumCache, StokesOperations, PolarizationCache):
+    def __init__(self, epochs, freq, I, Q=None, U=None, V=None, period=None, weights=None):
         """
         Create a new observation from I, Q, U, and V arrays.
         If one of Q, U, or V is present, all must be, and all must have the same shape as I.
+        The folding period of each subintegration (`period`) is optional,
+        but is needed to convert TOAs from phase bins to absolute times.
+        Channel weights (`weights`), of shape (nsub, nchan), default to one;
+        profiles with zero weight are skipped in averaging and timing.
         """
         self.epochs = epochs
         self.freq = freq
+        self.period = period
 
         self.full_stokes, self.shape = validate_stokes(I, Q, U, V)
         self.I = I
@@ -27,71 +81,301 @@ class Observation:
             self.U = U
             self.V = V
 
+        if weights is None:
+            weights = np.ones(self.shape[:-1])
+        self.weights = weights
+
         self.nbin = self.shape[-1]
         self.phase = np.linspace(0, 1, self.nbin, endpoint=False)
 
+        # Subint durations (s) and headers of the file the data came from,
+        # if any; set by from_file()
+        self.tsubint = None
+        self.source_headers = None
+
     @classmethod
-    def from_file(cls, filename):
+    def from_file(cls, filename, dtype=None, chunks=None):
         """
         Create a new observation from a PSRFITS file.
+
+        Parameters
+        ----------
+        filename: Path to the PSRFITS file.
+        dtype: Floating-point type of the decoded data. If `None`, use the
+               type resulting from applying DAT_SCL and DAT_OFFS (usually
+               float32). With float32 data, FFTs and cross-correlations are
+               also done in single precision, halving memory use; TOA
+               refinement, amplitudes, and uncertainties are still computed
+               in double precision. Since int16 samples are exactly
+               representable in float32, the only loss of accuracy is
+               rounding in the scaling and FFTs (relative error ~1e-7).
+               In tests on simulated data at S/N ~ 20 (tests/test_precision.py),
+               TOAs changed by < 1e-6 bins (< 1e-5 of their uncertainty)
+               and amplitudes by < 1e-7 (relative).
+        chunks: If given, the number of subintegrations per chunk. The data
+                are then not read into memory; instead, I, Q, U, and V are
+                dask arrays which read and decode each chunk on demand.
+                Requires dask.
         """
         hdul = fits.open(filename)
         data = hdul['SUBINT'].data['DATA']
-        dat_scl = hdul['SUBINT'].data['DAT_SCL']
-        dat_offs = hdul['SUBINT'].data['DAT_OFFS']
         dat_freq = hdul['SUBINT'].data['DAT_FREQ']
-        start_mjd = hdul['PRIMARY'].header['STT_IMJD']
-        start_sec = hdul['PRIMARY'].header['STT_SMJD']
-        start_offs = hdul['PRIMARY'].header['STT_OFFS']
         offs_sub = hdul['SUBINT'].data['OFFS_SUB']
         pol_type = hdul['SUBINT'].header['POL_TYPE'].upper()
         feed_poln = hdul['PRIMARY'].header['FD_POLN'].upper()
+        if 'PERIOD' in hdul['SUBINT'].columns.names:
+            period = hdul['SUBINT'].data['PERIOD']*u.s
+        else:
+            period = None
 
         nsub, npol, nchan, nbin = data.shape
-        newshape = (nsub, npol, nchan, 1)
-        scale = dat_scl.reshape(newshape)
-        offset = dat_offs.reshape(newshape)
-        data = data*scale + offset
+        if 'DAT_WTS' in hdul['SUBINT'].columns.names:
+            weights = np.array(hdul['SUBINT'].data['DAT_WTS']).reshape(nsub, nchan)
+        else:
+            weights = np.ones((nsub, nchan), dtype=np.float32)
+        if dtype is None:
+            scl_type = hdul['SUBINT'].data['DAT_SCL'].dtype
+            offs_type = hdul['SUBINT'].data['DAT_OFFS'].dtype
+            dtype = np.result_type(data.dtype, scl_type, offs_type)
+
+        if chunks is None:
+            data = decode_subints(hdul['SUBINT'].data, weights, dtype)
+        else:
+            try:
+                import dask.array as da
+            except ImportError:
+                raise ImportError("Reading data in chunks requires dask.") from None
+            lazy = LazyPsrfitsData(filename, data.shape, dtype)
+            data = da.from_array(lazy, chunks=(chunks, npol, nchan, nbin),
+                                 meta=np.empty((0, 0, 0, 0), dtype=dtype))
 
         freq = dat_freq[0]*u.MHz
-        start_time = Time(start_mjd, format='pulsar_mjd')
-        start_time += start_sec*u.s
-        start_time += start_offs*u.s
-        epochs = start_time + offs_sub*u.s
+        epochs = start_time_from_header(hdul['PRIMARY'].header) + offs_sub*u.s
+        if 'TSUBINT' in hdul['SUBINT'].columns.names:
+            tsubint = np.array(hdul['SUBINT'].data['TSUBINT'])
+        else:
+            tsubint = None
+        headers = {name: hdul[name].header.copy() for name in ('PRIMARY', 'SUBINT')}
         hdul.close()
 
         if pol_type in ['AA+BB', 'INTEN']:
             # Total intensity data
             I, = data.transpose(1, 0, 2, 3)
-            return cls(epochs, freq, I)
+            obs = cls(epochs, freq, I, period=period, weights=weights)
         elif pol_type == 'IQUV':
             # Full Stokes data
             I, Q, U, V = data.transpose(1, 0, 2, 3)
-            return cls(epochs, freq, I, Q, U, V)
+            obs = cls(epochs, freq, I, Q, U, V, period=period, weights=weights)
         elif pol_type == 'AABBCRCI':
             # Coherence data - convert to Stokes
             AA, BB, CR, CI = data.transpose(1, 0, 2, 3)
             I, Q, U, V = coherence_to_stokes(AA, BB, CR, CI, feed_poln)
-            return cls(epochs, freq, I, Q, U, V)
+            obs = cls(epochs, freq, I, Q, U, V, period=period, weights=weights)
         else:
             raise ValueError(f"Unrecognized polarization type '{pol_type}'.")
+        obs.tsubint = tsubint
+        obs.source_headers = headers
+        return obs
 
     def avg_portrait(self, noise_weight=True, unit_max=False):
-        I = np.nanmean(self.I, axis=0)
+        """
+        Average over subintegrations, weighting each profile by its channel
+        weight. Profiles with zero weight are skipped entirely, and NaN
+        samples are left out of the average of their phase bin (as with
+        `np.nanmean()`); bins with no finite samples are NaN. The weights
+        of the resulting Portrait are the summed weights of each channel.
+        For chunked (dask) data, the average is computed chunk by chunk
+        with the currently configured dask scheduler, and agrees with the
+        in-memory result up to floating-point summation order.
+        """
+        isub, ichan = np.nonzero(self.weights)
+        weights = np.zeros(self.shape[1])
+        np.add.at(weights, ichan, self.weights[isub, ichan])
+        # Channels with no weight at all average to zero
+        empty = np.where(weights > 0, np.nan, 0)[:, np.newaxis]
+
+        def finish(total, count):
+            out = np.broadcast_to(empty, total.shape).astype(total.dtype)
+            return np.divide(total, count, out=out, where=count > 0)
+
+        def weighted_mean(arr):
+            rows = arr[isub, ichan]
+            row_weights = self.weights[isub, ichan, np.newaxis].astype(rows.dtype)
+            finite = np.isfinite(rows)
+            total = np.zeros(arr.shape[1:], dtype=rows.dtype)
+            count = np.zeros(arr.shape[1:], dtype=rows.dtype)
+            if np.all(finite):
+                np.add.at(total, ichan, rows*row_weights)
+                count += weights[:, np.newaxis]
+            else:
+                np.add.at(total, ichan, np.where(finite, rows, 0)*row_weights)
+                np.add.at(count, ichan, finite*row_weights)
+            return finish(total, count)
+
+        if is_lazy(self.I):
+            # Build one task graph for all Stokes parameters, so that
+            # each chunk is read and decoded only once
+            import dask
+            w = self.weights[..., np.newaxis]
+            sums = []
+            for arr in self.stokes:
+                w_arr = w.astype(arr.dtype)
+                finite = arr.map_blocks(np.isfinite, dtype=bool)
+                sums.append((arr.map_blocks(np.nan_to_num)*w_arr).sum(axis=0))
+                sums.append((finite*w_arr).sum(axis=0))
+            sums = dask.compute(*sums)
+            means = [finish(total, count) for total, count in zip(sums[::2], sums[1::2])]
+        else:
+            means = [weighted_mean(arr) for arr in self.stokes]
+        portrait = Portrait(self.freq, *means, weights=weights)
+        portrait.source_headers = self.source_headers
+        return portrait
+
+    @property
+    def stokes(self):
+        """
+        List of the Stokes parameter arrays present ([I] or [I, Q, U, V]).
+        """
         if self.full_stokes:
-            Q = np.nanmean(self.Q, axis=0)
-            U = np.nanmean(self.U, axis=0)
-            V = np.nanmean(self.V, axis=0)
-            return Portrait(self.freq, I, Q, U, V)
+            return [self.I, self.Q, self.U, self.V]
         else:
-            return Portrait(self.freq, I)
+            return [self.I]
+
+    def compute(self):
+        """
+        Return a copy of this observation with any chunked (dask) arrays
+        computed and loaded into memory.
+        """
+        if is_lazy(self.I):
+            import dask
+            stokes = dask.compute(*self.stokes)
+        else:
+            stokes = self.stokes
+        return self._derived(*stokes)
+
+    def _derived(self, I, Q=None, U=None, V=None):
+        # A new observation with the same metadata as this one
+        obs = Observation(self.epochs, self.freq, I, Q, U, V, period=self.period,
+                          weights=self.weights)
+        obs.tsubint = self.tsubint
+        obs.source_headers = self.source_headers
+        return obs
 
     def __getitem__(self, key):
         I = self.I[key, ...]
+        weights = self.weights[key, ...]
         if self.full_stokes:
             Q = self.Q[key, ...]
             U = self.U[key, ...]
             V = self.V[key, ...]
-            return Portrait(self.freq, I, Q, U, V)
+            portrait = Portrait(self.freq, I, Q, U, V, weights=weights)
         else:
-            return Portrait(self.freq, I)
+            portrait = Portrait(self.freq, I, weights=weights)
+        portrait.source_headers = self.source_headers
+        return portrait
+
+    def quality_table(self, template=None, on_fraction=0.1, chunk_size=None):
+        """
+        Compute data-quality measures for every subintegration and channel
+        in one vectorized pass over the data (chunk by chunk for chunked
+        data), so that unusable profiles can be dropped before any fitting.
+        Off- and on-pulse windows are taken from a reference profile for
+        each channel: the template, if given, or else the average portrait
+        (which costs an extra pass over the data).
+
+        Parameters
+        ----------
+        template: Profile, Portrait, or SplineModel used as the reference.
+        on_fraction: The on-pulse window of each channel holds the bins where
+                     the reference exceeds this fraction of its peak.
+        chunk_size: Number of subints to process at once (by default, see
+                    `chunk_length()` in `chroniton.utils`).
+
+        Returns a structured array of shape (nsub, nchan) with fields
+        'baseline' (off-pulse mean), 'rms' (off-pulse standard deviation),
+        'snr' (baseline-subtracted on-pulse sum divided by its expected
+        noise), 'nan_frac' (fraction of non-finite samples, which are
+        treated as zero), and 'corr' (peak over phase of the correlation
+        coefficient with the reference, after removing the means; NaN for
+        constant profiles).
+        """
+        from .quality import quality_table
+        return quality_table(self, template=template, on_fraction=on_fraction,
+                             chunk_size=chunk_size)
+
+    def rm_synthesis(self, phi, bins=None, method='nufft'):
+        """
+        Compute the Faraday dispersion function of each phase bin over a
+        grid of trial rotation measures `phi` (rad/m**2), weighting each
+        channel by its weight. Returns a complex array of shape
+        (nsub, nphi, nbin) and the reference squared wavelength (m**2).
+        See `chroniton.rm.rm_synthesis()` for details.
+        """
+        if not self.full_stokes:
+            raise ValueError("RM synthesis requires full Stokes data.")
+        from .rm import rm_synthesis
+        return rm_synthesis(self.Q, self.U, self.freq, phi, weights=self.weights,
+                            bins=bins, method=method)
+
+    def derotate(self, rm, lam2_ref=0.0):
+        """
+        Return a copy with Faraday rotation removed, rotating Q and U in
+        every channel back to the squared wavelength `lam2_ref` (m**2;
+        by default, infinite frequency).
+
+        Parameters
+        ----------
+        rm: Rotation measure (rad/m**2), either a scalar or one value
+            per subintegration.
+        lam2_ref: Reference squared wavelength (m**2).
+        """
+        if not self.full_stokes:
+            raise ValueError("Derotation requires full Stokes data.")
+        from .rm import derotate
+        Q, U = derotate(self.Q, self.U, self.freq, rm, lam2_ref)
+        return self._derived(self.I.copy(), Q, U, self.V.copy())
+
+    def align(self, predictor, inplace=False):
+        """
+        Rotate each subintegration so that phase zero of a timing model
+        falls at the first bin, using the phases predicted at the subint
+        epochs by a PhasePredictor (see `predictor.PhasePredictor`). The
+        phases of all subints are evaluated at once, and the whole
+        observation is rotated in one batched pass in the Fourier domain.
+        Returns a new Observation unless `inplace` is `True`.
+        """
+        _, frac = predictor.phase(self.epochs)
+        return self.rotate(frac[:, np.newaxis]*self.nbin, inplace=inplace)
+
+    def to_file(self, filename, requantize=True, overwrite=False,
+                primary_header=None, subint_header=None):
+        """
+        Write the observation to a PSRFITS file, one subintegration at a
+        time (one chunk at a time for chunked data), so that the output
+        never needs to be in memory at once. Data are written as Stokes
+        parameters (POL_TYPE 'IQUV' or 'AA+BB').
+
+        Parameters
+        ----------
+        filename: Path of the file to create.
+        requantize: If `True`, store the data as 16-bit integers, with
+                    DAT_SCL and DAT_OFFS computed for each subint, channel,
+                    and polarization; otherwise store 32-bit floats.
+        overwrite: Whether to overwrite an existing file.
+        primary_header, subint_header: Additional header cards. Cards from
+                    the file the observation was read from are propagated
+                    automatically, except those describing the data layout.
+        """
+        from .psrfits import write_observation
+        write_observation(self, filename, requantize=requantize, overwrite=overwrite,
+                          primary_header=primary_header, subint_header=subint_header)
+
+    def to_shared(self, backing='shm', directory=None):
+        """
+        Copy the data into shared memory (or a memory-mapped scratch file),
+        so that worker processes can attach to it without copying.
+        Returns a `SharedStokes` object; pass its `handle` to workers.
+        See `chroniton.shared.SharedStokes` for details.
+        """
+        from .shared import SharedStokes
+        return SharedStokes(self, backing=backing, directory=directory)
@@ -0,0 +1,229 @@
+import numpy as np
+import scipy.fft
+import astropy.units as u
+from astropy.time import Time
+
+from .observation import Observation
+from .portrait import Portrait
+from .toas import template_portrait, _toa_block, TOA_RESULT_DTYPE
+
+class OnlineObservation:
+    def __init__(self, freq, nbin, capacity, full_stokes=False, template=None,
+                 window=False, dtype=np.float32):
+        """
+        An observation that is built up one subintegration at a time, as
+        data arrive from a backend. The most recent `capacity` subints are
+        kept in a ring buffer, so memory use is bounded however long the
+        observation runs. Running weighted sums are updated as each subint
+        is appended, so the average portrait is available at any time
+        without revisiting earlier data. If a template is given, TOAs for
+        each channel of each new subint are computed as it is appended.
+
+        Parameters
+        ----------
+        freq: Channel frequencies (Astropy Quantity).
+        nbin: Number of phase bins.
+        capacity: Number of subintegrations to keep in the ring buffer.
+        full_stokes: Whether subints carry I, Q, U, and V (otherwise I only).
+        template: Profile, Portrait, or SplineModel against which to time
+                  each subint, or `None` to skip timing.
+        window: If `True`, the running average covers only the subints in
+                the buffer (those pushed out are subtracted again); if
+                `False`, it covers every subint appended so far.
+        dtype: Floating-point type of the buffered data. Running sums are
+               always kept in double precision.
+        """
+        self.freq = freq
+        self.nbin = nbin
+        self.capacity = capacity
+        self.full_stokes = full_stokes
+        self.window = window
+        self.phase = np.linspace(0, 1, nbin, endpoint=False)
+
+        nchan = len(freq)
+        npol = 4 if full_stokes else 1
+        self._data = np.zeros((npol, capacity, nchan, nbin), dtype=dtype)
+        self._weights = np.zeros((capacity, nchan))
+        self._jd = np.zeros((capacity, 2))
+        self._period = np.full(capacity, np.nan)
+        self._toas = np.full((capacity, nchan), np.nan, dtype=TOA_RESULT_DTYPE)
+        self._scale = None
+        self.count = 0
+
+        self._sum = np.zeros((npol, nchan, nbin))
+        self._weight_sum = np.zeros(nchan)
+        self._cumulative = None
+
+        self.template = None
+        self.set_template(template)
+
+    @property
+    def nsub(self):
+        """
+        Number of subintegrations currently held in the buffer.
+        """
+        return min(self.count, self.capacity)
+
+    @property
+    def _order(self):
+        # Buffer slots of the held subints, oldest first
+        return (self.count - self.nsub + np.arange(self.nsub)) % self.capacity
+
+    def set_template(self, template):
+        """
+        Set (or clear, if `None`) the template used to time new subints.
+        The template is evaluated on the channel frequencies once, here.
+        TOAs already computed are kept.
+        """
+        self.template = template
+        self._cumulative = None
+        if template is None:
+            self._template = None
+            self._template_rfft = None
+        else:
+            self._template = template_portrait(template, self.freq, self.nbin)
+            self._template_rfft = scipy.fft.rfft(self._template)
+
+    def append(self, epoch, I, Q=None, U=None, V=None, period=None, weights=None):
+        """
+        Add one subintegration, of shape (nchan, nbin) per Stokes parameter,
+        overwriting the oldest subint if the buffer is full. The running
+        sums (and, if a template is set, TOAs) are updated at a cost
+        proportional to the size of one subint. Profiles with zero weight
+        are stored but not averaged or timed. Returns the TOAs of the new
+        subint (as from `make_toas()`), or `None` if no template is set.
+
+        Parameters
+        ----------
+        epoch: Start time of the subint (astropy Time).
+        I, Q, U, V: Stokes parameters of the subint.
+        period: Folding period (Astropy Quantity), needed for absolute TOAs.
+        weights: Channel weights, of shape (nchan,); default one.
+        """
+        stokes = [I, Q, U, V] if self.full_stokes else [I]
+        if any(arr is None for arr in stokes):
+            raise ValueError("This observation holds full Stokes data; supply I, Q, U, and V.")
+        data = np.stack([np.asarray(arr) for arr in stokes])
+        if data.shape[1:] != self._data.shape[2:]:
+            raise ValueError(
+                f"Subint shape {data.shape[1:]} does not match observation "
+                f"({self._data.shape[2]} channels, {self.nbin} bins)."
+            )
+        if weights is None:
+            weights = np.ones(data.shape[1])
+        weights = np.asarray(weights, dtype=np.float64)
+
+        slot = self.count % self.capacity
+        if self.window and self.count >= self.capacity:
+            self._accumulate(self._data[:, slot], self._weights[slot], -1)
+        self._data[:, slot] = data
+        self._weights[slot] = weights
+        self._accumulate(self._data[:, slot], weights, 1)
+
+        if self._scale is None:
+            self._scale = epoch.scale
+        epoch = getattr(epoch, self._scale)
+        self._jd[slot] = epoch.jd1, epoch.jd2
+        self._period[slot] = np.nan if period is None else period.to_value(u.s)
+        self.count += 1
+        self._cumulative = None
+
+        if self._template is None:
+            self._toas[slot] = np.nan
+            return None
+        self._toas[slot] = _toa_block(self._data[0, slot], weights, self._template,
+                                      template_rfft=self._template_rfft)
+        result = self._toas[slot]
+        return result['toa'], result['error'], result['ampl']
+
+    def extend(self, obs):
+        """
+        Append every subintegration of an Observation in turn.
+        """
+        period = obs.period
+        for i in range(obs.shape[0]):
+            self.append(obs.epochs[i], *(arr[i] for arr in obs.stokes),
+                        period=None if period is None else period[i],
+                        weights=obs.weights[i])
+
+    def _accumulate(self, data, weights, sign):
+        mask = weights > 0
+        rows = np.nan_to_num(data[:, mask]).astype(np.float64)
+        rows *= weights[mask, np.newaxis]
+        self._sum[:, mask] += sign*rows
+        self._weight_sum[mask] += sign*weights[mask]
+
+    def cumulative_portrait(self):
+        """
+        Return the current weighted average over subintegrations, as from
+        `Observation.avg_portrait()`, without reprocessing earlier subints.
+        """
+        if self._cumulative is None:
+            # With a sliding window, channels whose subints have all been
+            # pushed out may be left with rounding residue instead of zero
+            weights = np.where(self._weight_sum > 1e-12*self._weight_sum.max(initial=0),
+                               self._weight_sum, 0)
+            norm = np.where(weights > 0, weights, 1)[:, np.newaxis]
+            means = [(total/norm).astype(self._data.dtype) for total in self._sum]
+            self._cumulative = Portrait(self.freq, *means, weights=weights)
+        return self._cumulative
+
+    def cumulative_toas(self):
+        """
+        Return TOAs (in bins), uncertainties, and amplitudes for each channel
+        of the cumulative portrait. The cost does not grow with the number of
+        subints appended. Requires a template.
+        """
+        if self._template is None:
+            raise ValueError("No template set; cannot calculate TOAs.")
+        portrait = self.cumulative_portrait()
+        result = _toa_block(portrait.I, portrait.weights, self._template,
+                            profile_rfft=portrait.spectrum('I'),
+                            template_rfft=self._template_rfft)
+        return result['toa'], result['error'], result['ampl']
+
+    @property
+    def epochs(self):
+        """
+        Epochs of the subints held in the buffer, oldest first.
+        """
+        jd = self._jd[self._order]
+        epochs = Time(jd[:, 0], jd[:, 1], format='jd', scale=self._scale or 'utc')
+        epochs.format = 'pulsar_mjd'
+        return epochs
+
+    @property
+    def period(self):
+        """
+        Folding periods of the subints held in the buffer, oldest first,
+        or `None` if any of them was appended without a period.
+        """
+        period = self._period[self._order]
+        if np.isnan(period).any():
+            return None
+        return period*u.s
+
+    @property
+    def weights(self):
+        """
+        Channel weights of the subints held in the buffer, oldest first.
+        """
+        return self._weights[self._order]
+
+    @property
+    def toas(self):
+        """
+        TOAs (in bins), uncertainties, and amplitudes of the subints held in
+        the buffer, oldest first, each of shape (nsub, nchan). Subints
+        appended without a template have NaN TOAs.
+        """
+        result = self._toas[self._order]
+        return result['toa'], result['error'], result['ampl']
+
+    def to_observation(self):
+        """
+        Return a copy of the buffered subints as an Observation, oldest first.
+        """
+        stokes = self._data[:, self._order]
+        return Observation(self.epochs, self.freq, *stokes, period=self.period,
+                           weights=self.weights)
@@ -0,0 +1,122 @@
+import numpy as np
+import astropy.units as u
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .observation import Observation
+from .toas import make_toas
+from .toa_table import ToaTable
+
+def prefetch(func, items, depth=2, max_workers=None, executor=None):
+    """
+    Apply `func` to each element of `items` in background threads, yielding
+    `(item, func(item))` pairs in the original order. At most `depth` calls
+    are in flight ahead of the consumer, which bounds the memory used by
+    results that have been computed but not yet consumed.
+
+    Parameters
+    ----------
+    func: Function to apply to each item (e.g., `Observation.from_file`).
+    items: Iterable of inputs. Consumed lazily, so it may be a generator.
+    depth: Maximum number of items to prefetch ahead of the consumer.
+    max_workers: Number of background threads. Defaults to `depth`.
+                 Ignored if `executor` is supplied.
+    executor: An existing `concurrent.futures.Executor` to submit work to
+              (e.g., a `ProcessPoolExecutor`). It is not shut down when
+              iteration finishes. If `None`, a thread pool is created.
+    """
+    if depth < 1:
+        raise ValueError(f"Prefetch depth must be at least 1 (got {depth}).")
+    if max_workers is None:
+        max_workers = depth
+
+    pending = deque()
+    owns_executor = executor is None
+    if owns_executor:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) > depth:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if owns_executor:
+            executor.shutdown(wait=True)
+
+def observation_toa_table(template, obs, filename='', site='', file_flags=None):
+    """
+    Calculate TOAs for every subintegration and channel of an Observation,
+    writing them directly into a preallocated ToaTable along with their
+    arrival times, frequencies, and indices. Profiles with zero weight
+    are omitted. The observation must have a
+    folding period (see `Observation.period`).
+
+    Parameters
+    ----------
+    template: Template Profile, Portrait, or SplineModel.
+    obs: Observation for which to calculate TOAs.
+    filename: Name of the file the observation came from.
+    site: Observatory code.
+    file_flags: Dictionary of flags (with scalar values) describing the file.
+    """
+    if obs.period is None:
+        raise ValueError("Observation has no folding period; cannot convert TOAs to times.")
+    nsub, nchan = obs.shape[:2]
+    if file_flags is None:
+        file_flags = {}
+    table = ToaTable.empty(
+        nsub*nchan if np.any(obs.weights > 0) else 0,
+        files=[filename],
+        sites=[site],
+        file_flags={name: [value] for name, value in file_flags.items()},
+    )
+    if len(table) == 0:
+        # Fully zapped observation: no TOAs
+        return table
+    data = table.data.reshape(nsub, nchan)
+    make_toas(template, obs, out=data)
+    data['subint'] = np.arange(nsub)[:, np.newaxis]
+    data['chan'] = np.arange(nchan)
+    data['nbin'] = obs.nbin
+    data['freq'] = obs.freq.to(u.MHz).value
+
+    # Drop zero-weight profiles, which were not timed
+    table = table[np.ravel(obs.weights > 0)]
+    data = table.data
+    isub = data['subint']
+    data['error'] *= (obs.period[isub]/obs.nbin).to(u.us).value
+    times = obs.epochs[isub] + data['toa']/obs.nbin*obs.period[isub]
+    mjds = times.pulsar_mjd_string
+    parts = np.char.partition(mjds, '.')
+    data['mjd_int'] = parts[..., 0].astype(np.int64)
+    data['mjd_frac'] = np.char.add('0.', parts[..., 2]).astype(np.float64)
+    return table
+
+def toa_pipeline(template, filenames, depth=2, loader=Observation.from_file):
+    """
+    Calculate TOAs for a sequence of PSRFITS files, loading and decoding the
+    next `depth` files in background threads while TOAs for the current file
+    are being computed. Results are yielded in the same order as `filenames`.
+
+    Parameters
+    ----------
+    template: Template Profile, Portrait, or SplineModel.
+    filenames: Iterable of paths to PSRFITS files.
+    depth: Maximum number of observations to hold in memory ahead of the one
+           currently being processed.
+    loader: Function used to load each file.
+
+    Yields
+    ------
+    (filename, obs, toas, errs, ampls), where `toas`, `errs`, and `ampls`
+    have shape (nsub, nchan).
+    """
+    for filename, obs in prefetch(loader, filenames, depth=depth):
+        toas, errs, ampls = make_toas(template, obs)
+        yield filename, obs, toas, errs, ampls
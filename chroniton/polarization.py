@@ -1,3 +1,8 @@
+import numpy as np
+from collections import namedtuple
+
+from .utils import offpulse_window, is_lazy, chunk_length
+
 def validate_stokes(I, Q=None, U=None, V=None):
     """
     Check that arrays representing Stokes parameters have compatible shapes,
@@ -41,3 +46,141 @@ def coherence_to_stokes(AA, BB, CR, CI, feed_poln):
         raise ValueError(f"Unrecognized feed polarization '{feed_poln}'.")
 
     return I, Q, U, V
+
+POLARIZATION_FIELDS = ('L', 'PA', 'PA_err', 'P', 'frac_L', 'frac_V', 'frac_P')
+Polarization = namedtuple('Polarization', POLARIZATION_FIELDS)
+
+def _offpulse_std(arr, opw, count):
+    mean = np.sum(np.where(opw, arr, 0), axis=-1, keepdims=True)/count
+    return np.sqrt(np.sum(np.where(opw, (arr - mean)**2, 0), axis=-1, keepdims=True)/count)
+
+def _polarization_block(I, Q, U, V, threshold, out):
+    # Fill `out` (a structured array or a mapping of arrays, with the same
+    # shape as the data) with the polarization products of each profile
+    opw = offpulse_window(I, I.shape[-1]//4)
+    count = np.sum(opw, axis=-1, keepdims=True)
+    sigma_I = _offpulse_std(I, opw, count)
+    var_Q = _offpulse_std(Q, opw, count)**2
+    var_U = _offpulse_std(U, opw, count)**2
+    var_V = _offpulse_std(V, opw, count)**2
+    var_L = (var_Q + var_U)/2
+    var_P = (var_Q + var_U + var_V)/3
+
+    # Debiased linear polarization (Everett & Weisberg 2001, eq. 11)
+    sq = np.square(Q)
+    sq += np.square(U)
+    L = out['L']
+    np.subtract(sq, var_L, out=L)
+    L[sq < 1.57**2*var_L] = 0
+    np.sqrt(L, out=L)
+
+    # Position angle (degrees), where L is significant
+    PA = out['PA']
+    np.arctan2(U, Q, out=PA)
+    np.degrees(PA, out=PA)
+    PA *= 0.5
+    PA_err = out['PA_err']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(np.sqrt(var_L), L, out=PA_err)
+    np.degrees(PA_err, out=PA_err)
+    PA_err *= 0.5
+    insignificant = L < threshold*np.sqrt(var_L)
+    PA[insignificant] = np.nan
+    PA_err[insignificant] = np.nan
+
+    # Debiased total polarization, as for L
+    sq += np.square(V)
+    P = out['P']
+    np.subtract(sq, var_P, out=P)
+    P[sq < 1.57**2*var_P] = 0
+    np.sqrt(P, out=P)
+
+    # Fractional polarization, where I is significant (and nonzero,
+    # since profiles with zero weight may be all zeros)
+    I_masked = np.where((I >= threshold*sigma_I) & (I != 0), I, np.nan)
+    np.divide(L, I_masked, out=out['frac_L'])
+    np.divide(V, I_masked, out=out['frac_V'])
+    np.divide(P, I_masked, out=out['frac_P'])
+    return out
+
+def _polarization_lazy_block(I, Q, U, V, threshold):
+    out = np.empty(I.shape, dtype=[(name, np.result_type(I.dtype, np.float32))
+                                   for name in POLARIZATION_FIELDS])
+    return _polarization_block(I, Q, U, V, threshold, out)
+
+def polarization_products(I, Q, U, V, threshold=3.0, chunk_size=None):
+    """
+    Calculate polarization products for a stack of full-Stokes profiles,
+    with pulse phase along the last axis. Off-pulse noise levels are
+    estimated separately for each profile, using the off-pulse window of I.
+
+    Returns a Polarization with the following fields, each with the
+    shape of the data:
+    L: Linear polarization, debiased following Everett & Weisberg (2001).
+    PA: Position angle (degrees), 0.5*arctan2(U, Q).
+    PA_err: Uncertainty in the position angle (degrees).
+    P: Total polarization, sqrt(Q**2 + U**2 + V**2), debiased as for L.
+    frac_L, frac_V, frac_P: L/I, V/I, and P/I.
+    PA and PA_err are NaN where L is below `threshold` times the noise,
+    and the fractions are NaN where I is below `threshold` times the noise.
+
+    Parameters
+    ----------
+    I, Q, U, V: Stokes parameters, of shape (..., nbin). If these are dask
+                arrays, the products are computed block by block using
+                the currently configured dask scheduler.
+    threshold: Significance (in units of the noise) required to report
+               position angles and fractional polarization.
+    chunk_size: Number of profiles to process at once (by default, see
+                `chunk_length()`).
+    """
+    if is_lazy(I):
+        dtype = np.result_type(I.dtype, np.float32)
+        result = I.map_blocks(
+            _polarization_lazy_block, Q, U, V, threshold=threshold,
+            dtype=[(name, dtype) for name in POLARIZATION_FIELDS],
+            meta=np.empty((0,)*I.ndim, dtype=[(name, dtype) for name in POLARIZATION_FIELDS]),
+        ).compute()
+        return Polarization(*(result[name] for name in POLARIZATION_FIELDS))
+
+    I, Q, U, V = (np.asarray(arr) for arr in (I, Q, U, V))
+    shape = I.shape
+    nbin = shape[-1]
+    dtype = np.result_type(I.dtype, np.float32)
+    products = Polarization(*(np.empty(shape, dtype=dtype) for _ in POLARIZATION_FIELDS))
+    rows = [arr.reshape(-1, nbin) for arr in (I, Q, U, V)]
+    out_rows = {name: arr.reshape(-1, nbin) for name, arr in zip(POLARIZATION_FIELDS, products)}
+    chunk_size = chunk_length(nbin, chunk_size)
+    for start in range(0, rows[0].shape[0], chunk_size):
+        block = slice(start, start + chunk_size)
+        _polarization_block(*(arr[block] for arr in rows), threshold,
+                            {name: arr[block] for name, arr in out_rows.items()})
+    return products
+
+class PolarizationCache:
+    """
+    Mixin for classes holding full-Stokes data, providing polarization
+    products computed over all profiles at once and cached on the object.
+    The cache is discarded whenever a Stokes parameter is reassigned;
+    code that modifies the arrays in place must call
+    `invalidate_polarization()` afterwards.
+    """
+    def polarization(self, threshold=3.0):
+        """
+        Return the polarization products (debiased linear and total
+        polarization, position angle and its uncertainty, and fractional
+        polarization) of every profile, computed on first use and cached.
+        See `polarization_products()` for details.
+        """
+        if not self.full_stokes:
+            raise ValueError("Polarization products require full Stokes data.")
+        cache = self.__dict__.setdefault('_polarization', {})
+        if threshold not in cache:
+            cache[threshold] = polarization_products(self.I, self.Q, self.U, self.V, threshold)
+        return cache[threshold]
+
+    def invalidate_polarization(self):
+        """
+        Discard any cached polarization products.
+        """
+        self.__dict__.pop('_polarization', None)
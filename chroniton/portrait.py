@@ -1,16 +1,20 @@
 import numpy as np
+import scipy.fft
 import matplotlib.pyplot as plt
 import astropy.units as u
 
-from .polarization import validate_stokes
+from .polarization import validate_stokes, PolarizationCache
 from .utils import fft_roll, symmetrize_limits
 from .profile import Profile
+from .spectra import SpectrumCache, StokesOperations
 
-class Portrait:
-    def __init__(self, freq, I, Q=None, U=None, V=None):
+class Portrait(SpectrumCache, StokesOperations, PolarizationCache):
+    def __init__(self, freq, I, Q=None, U=None, V=None, weights=None):
         """
         Create a new pulse portrait from frequency, I, Q, U, and V arrays.
         If one of Q, U, or V is present, all must be present with the same shape.
+        Channel weights (`weights`) default to one; channels with zero weight
+        are skipped in timing.
         """
         self.freq = freq
 
@@ -21,14 +25,29 @@ class Portrait:
             self.U = U
             self.V = V
 
+        if weights is None:
+            weights = np.ones(self.shape[:-1])
+        self.weights = weights
+
         self.nbin = self.shape[-1]
         self.phase = np.linspace(0, 1, self.nbin, endpoint=False)
 
+        # Headers of the file the data came from, if any
+        self.source_headers = None
+
     def plot(self, ax=None, what='I', shift=0.0, sym_lim=False, vmin=None, vmax=None,
-             **kwargs):
+             reduce='mean', resolution=None, **kwargs):
         """
         Plot the pulse portrait.
 
+        If the portrait has more channels or bins than the Axes has pixels,
+        it is first reduced to screen resolution by averaging (or taking the
+        maximum over) blocks of adjacent channels and bins. The rotation is
+        then applied to the reduced data, using its cached spectrum, so
+        repeated plots with different `shift`, `vmin`, or `vmax` do not
+        reprocess the full portrait. A regular frequency grid is drawn
+        with ax.imshow(), and an irregular one with ax.pcolormesh().
+
         Parameters
         ----------
         ax: Axes on which to plot periodic spectrum. If `None`,
@@ -36,26 +55,166 @@ class Portrait:
         what: Which Stokes parameter to plot: 'I', 'Q', 'U', or 'V'.
               Ignored if portrait only has total intensity data.
         shift: Rotation (in cycles) to apply before plotting.
+        reduce: How to combine blocks of channels and bins when reducing
+                the resolution: 'mean', 'max', or `None` to plot every
+                channel and bin.
+        resolution: Maximum number of (channels, bins) to plot. Defaults
+                    to the size of the Axes in pixels.
 
-        Additional keyword arguments are passed on to ax.pcolormesh().
+        Additional keyword arguments are passed on to ax.imshow()
+        or ax.pcolormesh().
         """
         if ax is None:
             fig = plt.figure()
             ax = fig.add_subplot()
+        if not self.full_stokes:
+            what = 'I'
+
+        if reduce is None:
+            factors = (1, 1)
+        else:
+            if resolution is None:
+                bbox = ax.get_window_extent()
+                resolution = (max(int(bbox.height), 1), max(int(bbox.width), 1))
+            factors = _pool_factors(self.shape, resolution)
+        freq, spectrum, arr = self._plot_view(what, factors, reduce)
+        if shift:
+            nbin = arr.shape[-1]
+            ramp = np.exp(-2j*np.pi*shift*nbin*scipy.fft.rfftfreq(nbin))
+            arr = scipy.fft.irfft(spectrum*ramp.astype(spectrum.dtype, copy=False), nbin)
 
-        arr = getattr(self, what)
-        arr = fft_roll(arr, shift*self.nbin)
         if sym_lim:
             vmin, vmax = symmetrize_limits(arr, vmin, vmax)
-        freq = self.freq.to(u.MHz).value
-        pc = ax.pcolormesh(self.phase - shift, freq, arr, vmin=vmin, vmax=vmax, **kwargs)
+        step = np.diff(freq)
+        if freq.size > 1 and np.allclose(step, step[0]):
+            half = step[0]/2
+            extent = (-shift - 0.5/self.nbin, 1 - shift - 0.5/self.nbin,
+                      freq[0] - half, freq[-1] + half)
+            kwargs.setdefault('aspect', 'auto')
+            kwargs.setdefault('interpolation', 'nearest')
+            pc = ax.imshow(arr, origin='lower', extent=extent, vmin=vmin, vmax=vmax, **kwargs)
+        else:
+            nbin = arr.shape[-1]
+            phase = (np.arange(nbin) + 0.5)/nbin - 0.5/self.nbin - shift
+            pc = ax.pcolormesh(phase, freq, arr, vmin=vmin, vmax=vmax, **kwargs)
         ax.set_xlabel('Phase (cycles)')
         ax.set_ylabel('Frequency (MHz)')
 
         return pc
 
+    def _plot_view(self, what, factors, reduce):
+        # Data reduced for plotting, with its spectrum, cached per Stokes
+        # parameter (the cache is discarded when that parameter changes)
+        views = self.__dict__.setdefault('_plot_views', {})
+        key = (factors, reduce)
+        if views.get(what, (None,))[0] != key:
+            freq = self.freq.to(u.MHz).value
+            arr = getattr(self, what)
+            if factors != (1, 1):
+                freq = _pool(freq[:, np.newaxis], (factors[0], 1), 'mean')[:, 0]
+                arr = _pool(arr, factors, reduce)
+            views[what] = (key, freq, scipy.fft.rfft(arr), arr)
+        return views[what][1:]
+
     def extract_profile(self, i):
         if self.full_stokes:
             return Profile(self.I[i], self.Q[i], self.U[i], self.V[i])
         else:
             return Profile(self.I[i])
+
+    def rm_synthesis(self, phi, bins=None, method='nufft'):
+        """
+        Compute the Faraday dispersion function of each phase bin over a
+        grid of trial rotation measures `phi` (rad/m**2), weighting each
+        channel by its weight. Returns a complex array of shape
+        (nphi, nbin) and the reference squared wavelength (m**2).
+        See `chroniton.rm.rm_synthesis()` for details.
+        """
+        if not self.full_stokes:
+            raise ValueError("RM synthesis requires full Stokes data.")
+        from .rm import rm_synthesis
+        return rm_synthesis(self.Q, self.U, self.freq, phi, weights=self.weights,
+                            bins=bins, method=method)
+
+    def derotate(self, rm, lam2_ref=0.0):
+        """
+        Return a copy with Faraday rotation removed, rotating Q and U in
+        every channel back to the squared wavelength `lam2_ref` (m**2;
+        by default, infinite frequency).
+
+        Parameters
+        ----------
+        rm: Rotation measure (rad/m**2).
+        lam2_ref: Reference squared wavelength (m**2).
+        """
+        if not self.full_stokes:
+            raise ValueError("Derotation requires full Stokes data.")
+        from .rm import derotate
+        Q, U = derotate(self.Q, self.U, self.freq, rm, lam2_ref)
+        portrait = Portrait(self.freq, self.I.copy(), Q, U, self.V.copy(), weights=self.weights)
+        portrait.source_headers = self.source_headers
+        return portrait
+
+    def to_file(self, filename, epoch=None, period=None, tsubint=0.0, requantize=True,
+                overwrite=False, primary_header=None, subint_header=None):
+        """
+        Write the portrait to a PSRFITS file, as a single subintegration.
+        Data are written as Stokes parameters (POL_TYPE 'IQUV' or 'AA+BB').
+
+        Parameters
+        ----------
+        filename: Path of the file to create.
+        epoch: Epoch of the portrait (astropy Time). Defaults to the start
+               time of the file the data came from.
+        period: Folding period (Astropy Quantity), if known.
+        tsubint: Integration time (seconds).
+        requantize: If `True`, store the data as 16-bit integers, with
+                    DAT_SCL and DAT_OFFS computed for each channel and
+                    polarization; otherwise store 32-bit floats.
+        overwrite: Whether to overwrite an existing file.
+        primary_header, subint_header: Additional header cards. Cards from
+                    the file the data were read from are propagated
+                    automatically, except those describing the data layout.
+        """
+        from .psrfits import write_portrait
+        write_portrait(self, filename, epoch=epoch, period=period, tsubint=tsubint,
+                       requantize=requantize, overwrite=overwrite,
+                       primary_header=primary_header, subint_header=subint_header)
+
+    def to_shared(self, backing='shm', directory=None):
+        """
+        Copy the data into shared memory (or a memory-mapped scratch file),
+        so that worker processes can attach to it without copying.
+        Returns a `SharedStokes` object; pass its `handle` to workers.
+        See `chroniton.shared.SharedStokes` for details.
+        """
+        from .shared import SharedStokes
+        return SharedStokes(self, backing=backing, directory=directory)
+
+def _pool_factors(shape, resolution):
+    # Block sizes reducing (nchan, nbin) to about `resolution`. The block
+    # size along phase must divide nbin, so that the result stays periodic;
+    # if the smallest sufficient size doesn't, use the largest divisor
+    # below it (which keeps more bins than asked for, rather than fewer)
+    nchan, nbin = shape
+    fchan = max(1, -(-nchan//resolution[0]))
+    fbin = max(1, -(-nbin//resolution[1]))
+    while nbin % fbin:
+        fbin -= 1
+    return fchan, fbin
+
+def _pool(arr, factors, reduce):
+    # Combine blocks of factors[0] channels and factors[1] bins; a partial
+    # block of channels at the end is padded with NaN
+    fchan, fbin = factors
+    nchan, nbin = arr.shape
+    pad = -nchan % fchan
+    if pad:
+        arr = np.concatenate([arr, np.full((pad, nbin), np.nan, dtype=arr.dtype)])
+    blocks = arr.reshape(-1, fchan, nbin//fbin, fbin)
+    if reduce == 'mean':
+        return np.nanmean(blocks, axis=(1, 3))
+    elif reduce == 'max':
+        return np.nanmax(blocks, axis=(1, 3))
+    else:
+        raise ValueError(f"Unrecognized reduction '{reduce}'.")
@@ -0,0 +1,150 @@
+import hashlib
+
+import numpy as np
+from numpy.polynomial import chebyshev
+import astropy.units as u
+from astropy.time import Time
+
+from .cache import ToaCache
+
+class PhasePredictor:
+    def __init__(self, start, segment_length, ref_int, ref_frac, coeffs):
+        """
+        A piecewise Chebyshev approximation to the pulse phase predicted by
+        a timing model, in the spirit of TEMPO polycos and PSRCHIVE
+        predictors. Segment `i` covers the interval from
+        `start + i*segment_length` to `start + (i + 1)*segment_length`.
+        Once built, the phase at any number of epochs is found with a few
+        array operations, without calling the timing model.
+
+        Parameters
+        ----------
+        start: Start of the first segment (astropy Time).
+        segment_length: Length of each segment (Astropy Quantity).
+        ref_int, ref_frac: Integer and fractional phase at the midpoint of
+                           each segment.
+        coeffs: Chebyshev coefficients of the phase relative to the midpoint
+                of each segment, as a function of time scaled to [-1, 1]
+                over the segment, of shape (nseg, ncoeff).
+        """
+        self.start = start
+        self.segment_length = segment_length
+        self.ref_int = np.asarray(ref_int, dtype=np.float64)
+        self.ref_frac = np.asarray(ref_frac, dtype=np.float64)
+        self.coeffs = np.asarray(coeffs, dtype=np.float64)
+        self.nseg = self.coeffs.shape[0]
+
+    @classmethod
+    def from_model(cls, model, start, end, site, freq=np.inf*u.MHz, segment_length=1*u.hour,
+                   ncoeff=12, cache=None, **kwargs):
+        """
+        Build a predictor from a PINT timing model, evaluating the model
+        once, at 2*`ncoeff` Chebyshev nodes in every segment. Segments are
+        aligned to a grid starting at midnight (UTC) of the start date, so
+        that predictors for overlapping spans share their segments.
+
+        Parameters
+        ----------
+        model: PINT TimingModel.
+        start, end: Span to cover (astropy Time).
+        site: Observatory code (as used by PINT) at which phases are predicted.
+        freq: Observing frequency (Astropy Quantity) at which phases are
+              predicted. By default, infinite frequency.
+        segment_length: Length of each segment (Astropy Quantity).
+        ncoeff: Number of Chebyshev coefficients per segment.
+        cache: A ToaCache (or the path of a directory in which to create
+               one) in which to store predictors between runs, keyed on
+               the model parameters and the span, site, and frequency.
+        Additional keyword arguments are passed to `pint.toa.get_TOAs_array()`.
+        """
+        length = segment_length.to_value(u.s)
+        origin = Time(np.floor(start.utc.mjd), format='pulsar_mjd', scale='utc')
+        first = int(np.floor((start - origin).to_value(u.s)/length))
+        last = max(int(np.ceil((end - origin).to_value(u.s)/length)), first + 1)
+        seg_start = origin + first*length*u.s
+        nseg = last - first
+        freq_mhz = freq.to_value(u.MHz)
+
+        if isinstance(cache, str):
+            cache = ToaCache(cache)
+        if cache is not None:
+            h = hashlib.sha256()
+            h.update(model.as_parfile(include_info=False).encode())
+            h.update(repr((site, float(freq_mhz), seg_start.utc.jd1, seg_start.utc.jd2,
+                           nseg, length, ncoeff, sorted(kwargs.items()))).encode())
+            key = h.hexdigest()
+            cached = cache.get(key)
+            if cached is not None:
+                return cls.from_arrays(cached)
+
+        from pint.toa import get_TOAs_array
+
+        # Chebyshev nodes of every segment, then the midpoints
+        npts = 2*ncoeff
+        x = np.cos(np.pi*(np.arange(npts) + 0.5)/npts)
+        offsets = (np.arange(nseg)[:, np.newaxis] + 0.5 + 0.5*x)*length
+        mid_offsets = (np.arange(nseg) + 0.5)*length
+        times = seg_start + np.concatenate([offsets.ravel(), mid_offsets])*u.s
+        toas = get_TOAs_array(times, site, freqs=np.full(len(times), freq_mhz)*u.MHz, **kwargs)
+        phase = model.phase(toas)
+        order = np.argsort(toas.table['index'])
+        int_phase = np.asarray(phase.int.value, dtype=np.float64)[order]
+        frac_phase = np.asarray(phase.frac.value, dtype=np.float64)[order]
+
+        ref_int = int_phase[-nseg:]
+        ref_frac = frac_phase[-nseg:]
+        rel = ((int_phase[:-nseg].reshape(nseg, npts) - ref_int[:, np.newaxis])
+               + (frac_phase[:-nseg].reshape(nseg, npts) - ref_frac[:, np.newaxis]))
+        coeffs = chebyshev.chebfit(x, rel.T, ncoeff - 1).T
+
+        predictor = cls(seg_start, segment_length, ref_int, ref_frac, coeffs)
+        if cache is not None:
+            cache.put(key, **predictor.to_arrays())
+        return predictor
+
+    @property
+    def end(self):
+        """
+        End of the last segment.
+        """
+        return self.start + self.nseg*self.segment_length
+
+    def phase(self, epochs):
+        """
+        Predicted phase at each of `epochs` (astropy Time), all evaluated at
+        once. Returns arrays of integer and fractional phase (in [0, 1)).
+        """
+        length = self.segment_length.to_value(u.s)
+        dt = np.asarray((epochs - self.start).to_value(u.s), dtype=np.float64)
+        if np.any(dt < 0) or np.any(dt > self.nseg*length):
+            raise ValueError("Epochs lie outside the span of the predictor.")
+        seg = np.minimum(np.floor(dt/length).astype(int), self.nseg - 1)
+        x = 2*dt/length - (2*seg + 1)
+        rel = chebyshev.chebval(x.ravel(), self.coeffs[seg.ravel()].T, tensor=False)
+        frac = self.ref_frac[seg] + rel.reshape(dt.shape)
+        whole = np.floor(frac)
+        return self.ref_int[seg] + whole, frac - whole
+
+    def to_arrays(self):
+        """
+        Return the predictor as a dictionary of arrays (see `from_arrays()`).
+        """
+        start = self.start.utc
+        return {
+            'start': np.array([start.jd1, start.jd2]),
+            'segment_length': np.array(self.segment_length.to_value(u.s)),
+            'ref_int': self.ref_int,
+            'ref_frac': self.ref_frac,
+            'coeffs': self.coeffs,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Recreate a predictor from the dictionary of arrays returned by `to_arrays()`.
+        """
+        jd1, jd2 = arrays['start']
+        start = Time(jd1, jd2, format='jd', scale='utc')
+        start.format = 'pulsar_mjd'
+        return cls(start, float(arrays['segment_length'])*u.s, arrays['ref_int'],
+                   arrays['ref_frac'], arrays['coeffs'])
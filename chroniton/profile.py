@@ -1,13 +1,13 @@
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
-import scipy.signal
 from astropy.io import fits
 
 from .utils import fft_roll
-from .polarization import validate_stokes, coherence_to_stokes
+from .polarization import validate_stokes, coherence_to_stokes, PolarizationCache
+from .spectra import SpectrumCache, StokesOperations
 
-class Profile:
+class Profile(SpectrumCache, StokesOperations, PolarizationCache):
     def __init__(self, I, Q=None, U=None, V=None):
         """
         Create a new profile from I, Q, U, and V arrays.
@@ -60,6 +60,10 @@ class Profile:
         if data.shape[2] != 1:
             raise ValueError(f"Template should have 1 channel (found {data.shape[2]}).")
 
+        if 'DAT_WTS' in hdul['SUBINT'].columns.names:
+            if np.all(hdul['SUBINT'].data['DAT_WTS'] == 0):
+                raise ValueError("Template channel has zero weight.")
+
         npol = data.shape[1]
         newshape = (1, npol, 1, 1)
         scale = hdul['SUBINT'].data['DAT_SCL'].reshape(newshape)
@@ -169,17 +173,3 @@ class Profile:
         ax.set_ylabel("Intensity")
         ax.legend()
         return artists
-
-    def resample(self, nbin):
-        """
-        Resample the profile to a given number of phase bins.
-        Returns a new Profile object.
-        """
-        I = scipy.signal.resample(self.I, nbin)
-        if self.full_stokes:
-            Q = scipy.signal.resample(self.Q, nbin)
-            U = scipy.signal.resample(self.U, nbin)
-            V = scipy.signal.resample(self.V, nbin)
-            return Profile(I, Q, U, V)
-        else:
-            return Profile(I)
@@ -0,0 +1,292 @@
+import numpy as np
+from astropy.io import fits
+import astropy.units as u
+from astropy.time import Time
+
+from .utils import is_lazy
+
+# Keywords describing the layout of a binary table, which are set by the
+# writer and never copied from a source header
+_STRUCTURAL_KEYWORDS = ('XTENSION', 'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT', 'TFIELDS',
+                        'EXTNAME', 'SIMPLE', 'EXTEND')
+_STRUCTURAL_PREFIXES = ('NAXIS', 'TTYPE', 'TFORM', 'TUNIT', 'TDIM', 'TZERO', 'TSCAL',
+                        'TNULL', 'TDISP')
+
+def _is_structural(keyword):
+    return (keyword in _STRUCTURAL_KEYWORDS
+            or any(keyword.startswith(prefix) and keyword[len(prefix):].isdigit()
+                   for prefix in _STRUCTURAL_PREFIXES))
+
+def _merge_header(header, source):
+    # Copy the non-structural cards of `source` into `header`
+    if source is None:
+        return
+    for card in source.cards:
+        if card.keyword in ('', 'COMMENT', 'HISTORY') or _is_structural(card.keyword):
+            continue
+        header[card.keyword] = (card.value, card.comment)
+
+def split_start_time(start_time):
+    """
+    Split a start time (astropy Time) into the integer MJD, integer
+    seconds, and fractional seconds (STT_IMJD, STT_SMJD, STT_OFFS).
+    """
+    start_time = start_time.utc
+    imjd = int(np.floor(start_time.mjd))
+    day_start = Time(imjd, format='pulsar_mjd', scale='utc')
+    seconds = (start_time - day_start).to_value(u.s)
+    smjd = int(np.floor(seconds))
+    return imjd, smjd, seconds - smjd
+
+def start_time_from_header(header):
+    """
+    Start time of an observation (astropy Time) from the STT_IMJD,
+    STT_SMJD, and STT_OFFS cards of a PSRFITS primary header.
+    """
+    start_time = Time(header['STT_IMJD'], format='pulsar_mjd')
+    start_time += header['STT_SMJD']*u.s
+    start_time += header['STT_OFFS']*u.s
+    return start_time
+
+def quantize(data):
+    """
+    Quantize an array of shape (npol, nchan, nbin) to 16-bit integers, with
+    one scale and offset per polarization and channel chosen to span the
+    range of the data. Returns the integer data and the DAT_SCL and
+    DAT_OFFS values (each of shape (npol, nchan)), such that the data are
+    approximately `int_data*scale + offset`.
+    """
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(np.float64)
+    if not np.all(np.isfinite(data)):
+        data = np.nan_to_num(data)
+    lo = data.min(axis=-1)
+    hi = data.max(axis=-1)
+    offset = (hi.astype(np.float64) + lo)/2
+    scale = (hi.astype(np.float64) - lo)/(2*32767)
+    scale = np.where(scale > 0, scale, 1.0)
+    int_data = data - offset[..., np.newaxis].astype(data.dtype)
+    int_data /= scale[..., np.newaxis].astype(data.dtype)
+    np.rint(int_data, out=int_data)
+    np.clip(int_data, -32767, 32767, out=int_data)
+    return int_data.astype(np.int16), scale, offset
+
+class PsrfitsWriter:
+    def __init__(self, filename, nsub, npol, nchan, nbin, pol_type, start_time,
+                 primary_header=None, subint_header=None, requantize=True, overwrite=False):
+        """
+        Write a fold-mode PSRFITS file one subintegration at a time, so that
+        the whole data set never needs to be in memory. The number of
+        subintegrations must be known in advance; exactly `nsub` calls to
+        `write_subint()` must be made before `close()`.
+
+        Parameters
+        ----------
+        filename: Path of the file to create.
+        nsub, npol, nchan, nbin: Dimensions of the data.
+        pol_type: Polarization type ('AA+BB', 'INTEN', 'IQUV', or 'AABBCRCI').
+        start_time: Start time of the observation (astropy Time). Subint
+                    epochs are given relative to this in `write_subint()`.
+        primary_header, subint_header: Headers (e.g., from a source file)
+                    whose cards are copied into the new file. Cards
+                    describing the table layout or the data dimensions
+                    are always set by the writer.
+        requantize: If `True`, store the data as 16-bit integers with a
+                    scale and offset per polarization and channel (as is
+                    usual for PSRFITS); otherwise store 32-bit floats.
+        overwrite: Whether to overwrite an existing file.
+        """
+        self.filename = filename
+        self.shape = (npol, nchan, nbin)
+        self.nsub = nsub
+        self.requantize = requantize
+        self.count = 0
+
+        primary = fits.PrimaryHDU()
+        _merge_header(primary.header, primary_header)
+        imjd, smjd, offs = split_start_time(start_time)
+        primary.header['HDRVER'] = primary.header.get('HDRVER', '6.1')
+        primary.header['FITSTYPE'] = 'PSRFITS'
+        primary.header['OBS_MODE'] = 'PSR'
+        primary.header['STT_IMJD'] = imjd
+        primary.header['STT_SMJD'] = smjd
+        primary.header['STT_OFFS'] = offs
+        primary.header['OBSNCHAN'] = nchan
+        if 'FD_POLN' not in primary.header:
+            primary.header['FD_POLN'] = 'LIN'
+
+        data_format = f"{npol*nchan*nbin}{'I' if requantize else 'E'}"
+        columns = [
+            fits.Column(name='TSUBINT', format='1D', unit='s'),
+            fits.Column(name='OFFS_SUB', format='1D', unit='s'),
+            fits.Column(name='PERIOD', format='1D', unit='s'),
+            fits.Column(name='DAT_FREQ', format=f'{nchan}D', unit='MHz'),
+            fits.Column(name='DAT_WTS', format=f'{nchan}E'),
+            fits.Column(name='DAT_OFFS', format=f'{nchan*npol}E'),
+            fits.Column(name='DAT_SCL', format=f'{nchan*npol}E'),
+            fits.Column(name='DATA', format=data_format, dim=f'({nbin},{nchan},{npol})', unit='Jy'),
+        ]
+        subint = fits.BinTableHDU.from_columns(columns, nrows=0, name='SUBINT')
+        self.row_dtype = np.dtype([
+            (name, subint.data.dtype[name].base.newbyteorder('>'), subint.data.dtype[name].shape)
+            for name in subint.data.dtype.names
+        ])
+        header = subint.header
+        _merge_header(header, subint_header)
+        header['NAXIS2'] = nsub
+        header['POL_TYPE'] = pol_type
+        header['NPOL'] = npol
+        header['NCHAN'] = nchan
+        header['NBIN'] = nbin
+        header['NSBLK'] = 1
+        header['NBITS'] = 1
+        header['ZERO_OFF'] = 0
+        header['NSUBOFFS'] = 0
+        header['NCHNOFFS'] = 0
+        header['EPOCHS'] = 'VALID'
+
+        primary.writeto(filename, overwrite=overwrite)
+        self._stream = fits.StreamingHDU(filename, header)
+
+    def write_subint(self, data, offs_sub, freq, weights=None, period=None, tsubint=0.0):
+        """
+        Append one subintegration.
+
+        Parameters
+        ----------
+        data: Data of shape (npol, nchan, nbin), in the order given by the
+              polarization type.
+        offs_sub: Epoch of the subint relative to the start time (seconds).
+        freq: Channel frequencies (Astropy Quantity).
+        weights: Channel weights (default one).
+        period: Folding period (Astropy Quantity or seconds; default zero).
+        tsubint: Duration of the subint (seconds).
+        """
+        if self.count >= self.nsub:
+            raise ValueError(f"All {self.nsub} subintegrations have already been written.")
+        data = np.asarray(data)
+        if data.shape != self.shape:
+            raise ValueError(f"Subint has shape {data.shape}, expected {self.shape}.")
+        npol, nchan, nbin = self.shape
+
+        row = np.zeros(1, dtype=self.row_dtype)
+        if self.requantize:
+            int_data, scale, offset = quantize(data)
+            row['DATA'] = int_data
+            row['DAT_SCL'] = scale.ravel()
+            row['DAT_OFFS'] = offset.ravel()
+        else:
+            row['DATA'] = data
+            row['DAT_SCL'] = 1.0
+            row['DAT_OFFS'] = 0.0
+        row['TSUBINT'] = tsubint
+        row['OFFS_SUB'] = offs_sub
+        row['PERIOD'] = 0.0 if period is None else u.Quantity(period, u.s).value
+        row['DAT_FREQ'] = u.Quantity(freq, u.MHz).value
+        row['DAT_WTS'] = 1.0 if weights is None else weights
+        self._stream.write(row.view(np.uint8))
+        self.count += 1
+
+    def close(self):
+        """
+        Close the file, checking that every subintegration was written.
+        """
+        self._stream.close()
+        if self.count != self.nsub:
+            raise ValueError(
+                f"Only {self.count} of {self.nsub} subintegrations were written; "
+                f"'{self.filename}' is incomplete."
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._stream.close()
+
+def _output_headers(obj, primary_header, subint_header):
+    # Headers of the source file (if known), updated with user-supplied cards
+    source = getattr(obj, 'source_headers', None) or {}
+    headers = []
+    for name, extra in (('PRIMARY', primary_header), ('SUBINT', subint_header)):
+        header = fits.Header()
+        _merge_header(header, source.get(name))
+        _merge_header(header, extra)
+        headers.append(header)
+    primary, subint = headers
+    freq = obj.freq.to_value(u.MHz)
+    if freq.size > 1:
+        subint['CHAN_BW'] = float(freq[1] - freq[0])
+    primary['OBSFREQ'] = float(np.mean(freq))
+    return primary, subint
+
+def _subint_blocks(obs):
+    # Yield (index of first subint, data of shape (npol, n, nchan, nbin)),
+    # one subint at a time for in-memory data, or one chunk at a time for
+    # chunked (dask) data, so each chunk is read and decoded only once
+    if is_lazy(obs.I):
+        import dask
+        start = 0
+        for size in obs.I.chunks[0]:
+            block = dask.compute(*(arr[start:start + size] for arr in obs.stokes))
+            yield start, np.stack(block)
+            start += size
+    else:
+        for isub in range(obs.shape[0]):
+            yield isub, np.stack([arr[isub:isub + 1] for arr in obs.stokes])
+
+def write_observation(obs, filename, requantize=True, overwrite=False,
+                      primary_header=None, subint_header=None):
+    """
+    Write an Observation to a PSRFITS file, one subintegration at a time.
+    See `Observation.to_file()`.
+    """
+    primary, subint = _output_headers(obs, primary_header, subint_header)
+    if 'STT_IMJD' in primary:
+        start_time = start_time_from_header(primary)
+    else:
+        start_time = obs.epochs[0]
+    offs_sub = (obs.epochs - start_time).to_value(u.s)
+    if obs.period is not None:
+        subint['TBIN'] = obs.period[0].to_value(u.s)/obs.nbin
+    tsubint = getattr(obs, 'tsubint', None)
+
+    npol = 4 if obs.full_stokes else 1
+    pol_type = 'IQUV' if obs.full_stokes else 'AA+BB'
+    nsub, nchan, nbin = obs.shape
+    with PsrfitsWriter(filename, nsub, npol, nchan, nbin, pol_type, start_time,
+                       primary, subint, requantize=requantize, overwrite=overwrite) as writer:
+        for start, block in _subint_blocks(obs):
+            for j in range(block.shape[1]):
+                isub = start + j
+                writer.write_subint(
+                    block[:, j], offs_sub[isub], obs.freq, obs.weights[isub],
+                    period=None if obs.period is None else obs.period[isub],
+                    tsubint=0.0 if tsubint is None else tsubint[isub],
+                )
+
+def write_portrait(port, filename, epoch=None, period=None, tsubint=0.0, requantize=True,
+                   overwrite=False, primary_header=None, subint_header=None):
+    """
+    Write a Portrait to a PSRFITS file as a single subintegration.
+    See `Portrait.to_file()`.
+    """
+    primary, subint = _output_headers(port, primary_header, subint_header)
+    if epoch is None:
+        if 'STT_IMJD' not in primary:
+            raise ValueError("No epoch given, and none is available from the source file.")
+        epoch = start_time_from_header(primary)
+    if period is not None:
+        subint['TBIN'] = u.Quantity(period, u.s).value/port.nbin
+
+    npol = 4 if port.full_stokes else 1
+    pol_type = 'IQUV' if port.full_stokes else 'AA+BB'
+    stokes = [port.I, port.Q, port.U, port.V] if port.full_stokes else [port.I]
+    nchan, nbin = port.shape
+    with PsrfitsWriter(filename, 1, npol, nchan, nbin, pol_type, epoch, primary, subint,
+                       requantize=requantize, overwrite=overwrite) as writer:
+        writer.write_subint(np.stack(stokes), 0.0, port.freq, port.weights, period, tsubint)
@@ -0,0 +1,104 @@
+import numpy as np
+import scipy.fft
+
+from .utils import offpulse_window, is_lazy, chunk_length
+from .toas import template_portrait
+
+QUALITY_FIELDS = ('baseline', 'rms', 'snr', 'nan_frac', 'corr')
+QUALITY_DTYPE = np.dtype([(name, np.float64) for name in QUALITY_FIELDS])
+
+def _reference_windows(reference, on_fraction):
+    # Off- and on-pulse windows, and the conjugate spectrum of the
+    # mean-subtracted reference scaled to unit norm, for reference
+    # profiles of shape (..., nbin)
+    reference = np.nan_to_num(np.asarray(reference, dtype=np.float64))
+    opw = offpulse_window(reference, reference.shape[-1]//4)
+    count = np.sum(opw, axis=-1, keepdims=True)
+    pulse = reference - np.sum(np.where(opw, reference, 0), axis=-1, keepdims=True)/count
+    peak = np.max(pulse, axis=-1, keepdims=True)
+    onpw = (pulse > on_fraction*peak) & (peak > 0) & ~opw
+
+    centered = reference - reference.mean(axis=-1, keepdims=True)
+    norm = np.sqrt(np.sum(centered**2, axis=-1, keepdims=True))
+    ccf_spectrum = np.conj(scipy.fft.rfft(centered))
+    ccf_spectrum *= np.divide(1, norm, out=np.zeros(norm.shape), where=norm > 0)
+    return opw, onpw, ccf_spectrum
+
+def _quality_block(data, opw, onpw, ccf_spectrum, spectrum=None):
+    """
+    Compute the quality measures of a block of profiles of shape (..., nbin),
+    given windows and a reference spectrum broadcast against them.
+    Returns a structured array with dtype `QUALITY_DTYPE`.
+    """
+    nbin = data.shape[-1]
+    out = np.empty(data.shape[:-1], dtype=QUALITY_DTYPE)
+    finite = np.isfinite(data)
+    out['nan_frac'] = 1 - np.mean(finite, axis=-1)
+    if not np.all(finite):
+        data = np.where(finite, data, 0)
+        spectrum = None
+
+    off = opw & finite
+    on = onpw & finite
+    with np.errstate(divide='ignore', invalid='ignore'):
+        baseline = np.sum(np.where(off, data, 0), axis=-1, dtype=np.float64)/np.sum(off, axis=-1)
+        pulse = data - baseline[..., np.newaxis].astype(data.dtype)
+        rms = np.sqrt(np.sum(np.where(off, pulse**2, 0), axis=-1, dtype=np.float64)
+                      /np.sum(off, axis=-1))
+        on_sum = np.sum(np.where(on, pulse, 0), axis=-1, dtype=np.float64)
+        snr = on_sum/(rms*np.sqrt(np.sum(on, axis=-1)))
+    out['baseline'] = baseline
+    out['rms'] = rms
+    out['snr'] = np.where(rms > 0, snr, np.nan)
+
+    if spectrum is None:
+        spectrum = scipy.fft.rfft(data)
+    ccf = scipy.fft.irfft(spectrum*ccf_spectrum.astype(spectrum.dtype, copy=False), nbin)
+    centered = data - np.mean(data, axis=-1, keepdims=True, dtype=np.float64).astype(data.dtype)
+    norm = np.sqrt(np.sum(centered**2, axis=-1, dtype=np.float64))
+    out['corr'] = np.divide(np.max(ccf, axis=-1), norm, out=np.full(norm.shape, np.nan),
+                            where=norm > 0)
+    return out
+
+def _quality_lazy_block(data, opw, onpw, ccf_spectrum, block_info=None):
+    # Select the windows and reference spectrum matching this block of a dask array
+    location = block_info[0]['array-location']
+    index = tuple(slice(start, stop) for start, stop in location[:-1])
+    if opw.ndim > 1:
+        trailing = index[len(index) - (opw.ndim - 1):]
+        opw, onpw, ccf_spectrum = opw[trailing], onpw[trailing], ccf_spectrum[trailing]
+    return _quality_block(data, opw, onpw, ccf_spectrum)
+
+def quality_table(obs, template=None, on_fraction=0.1, chunk_size=None):
+    """
+    Compute data-quality measures for every profile of an Observation (or
+    Portrait) in one vectorized pass over the data, for deciding which
+    subintegrations and channels to drop before timing. See
+    `Observation.quality_table()`.
+    """
+    data = obs.I
+    nbin = data.shape[-1]
+    if template is not None:
+        reference = template_portrait(template, obs.freq, nbin)
+    else:
+        reference = obs.avg_portrait().I if hasattr(obs, 'avg_portrait') else data
+    opw, onpw, ccf_spectrum = _reference_windows(reference, on_fraction)
+
+    if is_lazy(data):
+        return data.map_blocks(
+            _quality_lazy_block, opw=opw, onpw=onpw, ccf_spectrum=ccf_spectrum,
+            drop_axis=data.ndim - 1, dtype=QUALITY_DTYPE,
+            meta=np.empty((0,)*(data.ndim - 1), dtype=QUALITY_DTYPE),
+        ).compute()
+
+    # Use the cached spectrum if there is one, but don't compute it just for this
+    spectrum = obs.cached_spectrum('I')
+    if data.ndim < 3:
+        return _quality_block(data, opw, onpw, ccf_spectrum, spectrum)
+    out = np.empty(data.shape[:-1], dtype=QUALITY_DTYPE)
+    chunk_size = chunk_length(np.prod(data.shape[1:]), chunk_size)
+    for start in range(0, data.shape[0], chunk_size):
+        block = slice(start, start + chunk_size)
+        out[block] = _quality_block(data[block], opw, onpw, ccf_spectrum,
+                                    None if spectrum is None else spectrum[block])
+    return out
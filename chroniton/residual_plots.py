@@ -3,6 +3,8 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import astropy.units as u
 import os.path
+import warnings
+import weakref
 from ruamel.yaml import YAML
 yaml = YAML(typ='safe')
 
@@ -25,8 +27,7 @@ def plot_residuals(resids, x='time', y=None, yerr=None, cat=None, ax=None, grid=
         xlabel = "Orbital phase (cycles)"
 
     if cat is None:
-        cat = np.array(resids.toas[colorby]) # absent flag = ''
-        cat[cat == ''] = 'None'
+        cat = residual_view(resids).flag(colorby)
 
     x, y, yerr, cat = get_plot_values(resids, x, y, yerr, cat, whiten=whiten, avg=avg)
     colorscheme = colorschemes[colorscheme]
@@ -41,28 +42,146 @@ def plot_residuals(resids, x='time', y=None, yerr=None, cat=None, ax=None, grid=
         plt.tight_layout()
     return artists
 
+class ResidualView:
+    def __init__(self, resids):
+        """
+        Quantities derived from a PINT Residuals object for plotting, each
+        computed (and converted to the units used for plotting) on first use
+        and then reused. Cached arrays are read-only, since they are shared
+        between callers. Use `residual_view()` to get the shared view of a
+        Residuals object, rather than creating one directly.
+
+        The view holds only a weak reference to `resids`, so that it does
+        not keep its own key in the cache of views alive.
+        """
+        self._resids = weakref.ref(resids)
+        self.state = self.state_of(resids)
+        self._cache = {}
+
+    @property
+    def resids(self):
+        resids = self._resids()
+        if resids is None:
+            raise ReferenceError("The residuals of this view no longer exist.")
+        return resids
+
+    @staticmethod
+    def state_of(resids):
+        """
+        A token identifying the TOAs and timing model behind `resids`;
+        if it changes, cached quantities are out of date.
+        """
+        return (id(resids.toas), len(resids.toas), id(resids.model))
+
+    def _get(self, key, func):
+        if key not in self._cache:
+            value = func()
+            for arr in (value if isinstance(value, tuple) else (value,)):
+                if isinstance(arr, np.ndarray):
+                    arr.flags.writeable = False
+            self._cache[key] = value
+        return self._cache[key]
+
+    def x(self, xtype):
+        """
+        Values for the x axis: 'time' (MJD), 'freq' (MHz), or 'orbphase' (cycles).
+        """
+        if xtype == 'freq':
+            return self._get('freq', lambda: self.resids.toas.get_freqs().to(u.MHz))
+        elif xtype == 'orbphase':
+            if self.resids.model.BINARY.value is None:
+                raise ValueError("Model has no binary component, cannot get orbital phase")
+            return self._get('orbphase', lambda: self.resids.model.orbital_phase(self.resids.toas))
+        elif xtype == 'time':
+            return self._get('time', lambda: self.resids.toas.get_mjds().to(u.d))
+        else:
+            raise ValueError(f"Unrecognized x-axis type '{xtype}'.")
+
+    def y(self, whiten=False):
+        """
+        Time residuals (us), with red and DM noise removed if `whiten` is `True`.
+        """
+        if not whiten:
+            return self._get('resids', lambda: self.resids.time_resids.to(u.us))
+        return self._get('whitened', self._whitened)
+
+    def _whitened(self):
+        y = self.y().copy()
+        print('Whitening...')
+        if not self.resids.noise_resids:
+            warnings.warn("No noise residuals available; residuals are not whitened.")
+        if 'pl_red_noise' in self.resids.noise_resids:
+            print('Removing red noise')
+            y -= self.resids.noise_resids['pl_red_noise']
+        if 'pl_DM_noise' in self.resids.noise_resids:
+            print('Removing DM noise')
+            y -= self.resids.noise_resids['pl_DM_noise']
+        return y
+
+    def yerr(self):
+        """
+        TOA uncertainties (us).
+        """
+        return self._get('yerr', lambda: self.resids.get_data_error().to(u.us))
+
+    def flag(self, name):
+        """
+        Values of a TOA flag, with 'None' where the flag is absent.
+        """
+        def get_flag():
+            cat = np.array(self.resids.toas[name]) # absent flag = ''
+            cat[cat == ''] = 'None'
+            return cat
+        return self._get(('flag', name), get_flag)
+
+    def groups(self, xtype):
+        """
+        Groups of TOAs averaged together for x-axis type `xtype` (TOAs from
+        the same file, or for frequency, the same file and channel), as
+        returned by `np.unique(..., return_index=True, return_inverse=True)`,
+        plus the number of TOAs in each group.
+        """
+        def get_groups():
+            if xtype == 'freq':
+                fs = self.resids.toas['f']
+                chans = self.resids.toas['chan']
+                groupid = np.array([f"{f}.{chan:>02}" for (f, chan) in zip(fs, chans)])
+            else:
+                groupid = self.resids.toas['name']
+            uniq, idx, inv = np.unique(groupid, return_index=True, return_inverse=True)
+            return uniq, idx, inv, np.bincount(inv)
+        return self._get(('groups', xtype), get_groups)
+
+_views = weakref.WeakKeyDictionary()
+
+def residual_view(resids):
+    """
+    Return the cached ResidualView of `resids`, creating a new one on first
+    use or if the TOAs or model of `resids` have been replaced. If the model
+    is refit in place, call `invalidate_residual_view()` afterwards.
+    """
+    view = _views.get(resids)
+    if view is None or view.state != ResidualView.state_of(resids):
+        view = ResidualView(resids)
+        _views[resids] = view
+    return view
+
+def invalidate_residual_view(resids=None):
+    """
+    Discard cached plotting quantities for `resids`, or for all residuals
+    if `resids` is `None`.
+    """
+    if resids is None:
+        _views.clear()
+    else:
+        _views.pop(resids, None)
+
 def get_plot_values(resids, x='time', y=None, yerr=None, cat=None, whiten=False, avg=False):
+    view = residual_view(resids)
     xtype = x
-    if x == 'freq':
-        x = resids.toas.get_freqs()
-    elif x == 'orbphase':
-        if resids.model.BINARY.value is None:
-            raise ValueError("Model has no binary component, cannot get orbital phase")
-        x = resids.model.orbital_phase(resids.toas)
-    elif x == 'time':
-        x = resids.toas.get_mjds()
+    x = view.x(xtype)
     if y is None:
-        y = resids.time_resids.copy()
-        if whiten:
-            print('Whitening...')
-            if not resids.noise_resids:
-                warnings.warn('')
-            if 'pl_red_noise' in resids.noise_resids:
-                print('Removing red noise')
-                y -= resids.noise_resids['pl_red_noise']
-            if 'pl_DM_noise' in resids.noise_resids:
-                print('Removing DM noise')
-                y -= resids.noise_resids['pl_DM_noise']
+        y = view.y(whiten)
         #if correct_offset:
         #    y -= np.dot(fitter.current_state.M[:,0], fitter.current_state.xhat[0]) * u.s
         #if correct_timing_model:
@@ -70,24 +189,19 @@ def get_plot_values(resids, x='time', y=None, yerr=None, cat=None, whiten=False,
         #    ntmpar = len(fitp)
         #    y -= np.dot(fitter.current_state.M[:,1:1+ntmpar], fitter.current_state.xhat[1:1+ntmpar]) * u.s
     if yerr is None:
-        yerr = resids.get_data_error()
+        yerr = view.yerr()
 
     if avg:
         if xtype == 'time':
-            groupid = resids.toas['name']
             x_unit = u.d
         elif xtype == 'freq':
-            fs = resids.toas['f']
-            chans = resids.toas['chan']
-            groupid = np.array([f"{f}.{chan:>02}" for (f, chan) in zip(fs, chans)])
             x_unit = u.MHz
         elif xtype == 'orbphase':
-            groupid = resids.toas['name']
             x_unit = u.Unit()
-        uniq, idx, inv = np.unique(groupid, return_index=True, return_inverse=True)
-        x = np.bincount(inv, weights=x.to(x_unit).value)/np.bincount(inv)*x_unit
-        y = np.bincount(inv, weights=np.float64(y.to(u.us).value))/np.bincount(inv)*u.us
-        yerr = np.sqrt(np.bincount(inv, weights=yerr.to(u.us).value**2)/np.bincount(inv)**2)*u.us
+        uniq, idx, inv, counts = view.groups(xtype)
+        x = np.bincount(inv, weights=x.to(x_unit).value)/counts*x_unit
+        y = np.bincount(inv, weights=np.float64(y.to(u.us).value))/counts*u.us
+        yerr = np.sqrt(np.bincount(inv, weights=yerr.to(u.us).value**2)/counts**2)*u.us
         if cat is not None:
             cat = cat[idx]
 
@@ -0,0 +1,135 @@
+import numpy as np
+import scipy.fft
+import scipy.sparse
+import astropy.units as u
+from astropy.constants import c
+
+from .utils import chunk_length
+
+def lambda_squared(freq):
+    """
+    Squared wavelength (m**2) of each frequency (Astropy Quantity).
+    """
+    return ((c/freq)**2).to_value(u.m**2)
+
+def _gridding_matrix(x, nmodes, oversample=2, nspread=12):
+    # Sparse matrix spreading sources at positions `x` (radians) onto a
+    # uniform grid with a Gaussian kernel, as in the type-1 NUFFT of
+    # Greengard & Lee (2004, SIAM Review 46, 443)
+    ngrid = oversample*nmodes
+    tau = np.pi*nspread/(nmodes**2*oversample*(oversample - 0.5))
+    nearest = np.floor(x*ngrid/(2*np.pi)).astype(int)
+    offsets = np.arange(-nspread + 1, nspread + 1)
+    grid = nearest[:, np.newaxis] + offsets
+    values = np.exp(-(x[:, np.newaxis] - 2*np.pi*grid/ngrid)**2/(4*tau))
+    rows = np.broadcast_to(np.arange(x.size)[:, np.newaxis], grid.shape)
+    matrix = scipy.sparse.csr_matrix(
+        (values.ravel(), (rows.ravel(), (grid % ngrid).ravel())), shape=(x.size, ngrid)
+    )
+    return matrix, tau
+
+def rm_synthesis(Q, U, freq, phi, weights=None, bins=None, method='nufft', chunk_size=None):
+    """
+    Compute the Faraday dispersion function (Brentjens & de Bruyn 2005)
+    of each phase bin of a stack of portraits, on a grid of trial rotation
+    measures, with channels along the second-to-last axis and pulse phase
+    along the last. The sum over channels is evaluated for all profiles at
+    once, either with a non-uniform FFT over the trial RM grid ('nufft',
+    accurate to ~1e-10 relative to the peak, which requires a uniform grid)
+    or by multiplying by the exact matrix of phase factors ('direct').
+
+    Parameters
+    ----------
+    Q, U: Stokes parameters, of shape (..., nchan, nbin).
+    freq: Channel frequencies (Astropy Quantity).
+    phi: Trial rotation measures (rad/m**2).
+    weights: Channel weights, of shape (nchan,) or broadcast against the
+             data without the phase axis (e.g., (nsub, nchan)). The
+             reference wavelength is the weighted mean of the squared
+             wavelengths over all channels and subintegrations.
+    bins: Phase bins to include (an index array, slice, or boolean mask),
+          e.g., the on-pulse region. By default, all bins are used.
+    method: 'nufft' or 'direct'.
+    chunk_size: Number of profiles to process at once. By default, this
+                depends on the size of the transform of each profile
+                (see `chunk_length()`).
+
+    Returns a complex array of shape (..., nphi, nbin) (with `nbin` the
+    number of bins selected), and the reference squared wavelength (m**2).
+    """
+    phi = np.asarray(phi, dtype=np.float64)
+    lam2 = lambda_squared(freq)
+    P = np.asarray(Q) + 1j*np.asarray(U)
+    if bins is not None:
+        P = P[..., bins]
+    nchan = lam2.size
+    if weights is None:
+        weights = np.ones(nchan)
+    weights = np.broadcast_to(np.asarray(weights, dtype=np.float64), P.shape[:-1])
+    channel_weights = weights.reshape(-1, nchan).sum(axis=0)
+    if not np.any(channel_weights > 0):
+        raise ValueError("All channels have zero weight.")
+    lam2_ref = np.sum(channel_weights*lam2)/np.sum(channel_weights)
+
+    # One row per (profile, bin), with channels along the last axis
+    P = np.swapaxes(P, -1, -2)
+    out_shape = P.shape[:-1] + (phi.size,)
+    coeffs = (P*weights[..., np.newaxis, :]).reshape(-1, nchan)
+    norm = np.broadcast_to(np.sum(weights, axis=-1)[..., np.newaxis], P.shape[:-1]).ravel()
+    norm = np.where(norm > 0, norm, np.inf)
+    dlam2 = lam2 - lam2_ref
+
+    if method == 'nufft':
+        nphi = phi.size
+        step = (phi[-1] - phi[0])/(nphi - 1) if nphi > 1 else 1.0
+        if nphi > 1 and not np.allclose(np.diff(phi), step, rtol=1e-6, atol=0):
+            raise ValueError("The 'nufft' method requires a uniform grid of trial RMs.")
+        # phi[j] = center + k*step, with k = j - nphi//2
+        center = phi[0] + (nphi//2)*step
+        coeffs = coeffs*np.exp(-2j*center*dlam2)
+        matrix, tau = _gridding_matrix(np.mod(2*step*dlam2, 2*np.pi), nphi)
+        ngrid = matrix.shape[1]
+        k = np.arange(nphi) - nphi//2
+        deconvolve = np.sqrt(np.pi/tau)*np.exp(k**2*tau)/ngrid
+        def transform(block):
+            grid = (matrix.T @ block.T).T
+            return scipy.fft.fft(grid, axis=-1)[:, k % ngrid]*deconvolve
+        row_size = ngrid
+    elif method == 'direct':
+        kernel = np.exp(-2j*np.outer(dlam2, phi))
+        def transform(block):
+            return block @ kernel
+        row_size = phi.size
+    else:
+        raise ValueError(f"Unrecognized method '{method}'.")
+
+    fdf = np.empty((coeffs.shape[0], phi.size), dtype=np.complex128)
+    chunk_size = chunk_length(max(row_size, nchan), chunk_size)
+    for start in range(0, coeffs.shape[0], chunk_size):
+        block = slice(start, start + chunk_size)
+        fdf[block] = transform(coeffs[block])/norm[block, np.newaxis]
+    return np.swapaxes(fdf.reshape(out_shape), -1, -2), lam2_ref
+
+def derotate(Q, U, freq, rm, lam2_ref=0.0):
+    """
+    Undo Faraday rotation, rotating the plane of linear polarization of
+    every channel back to the reference squared wavelength `lam2_ref`
+    (m**2; by default, infinite frequency). Channels are along the
+    second-to-last axis and pulse phase along the last.
+
+    Parameters
+    ----------
+    Q, U: Stokes parameters, of shape (..., nchan, nbin).
+    freq: Channel frequencies (Astropy Quantity).
+    rm: Rotation measure (rad/m**2), either a scalar or an array broadcast
+        against the data without the channel and phase axes
+        (e.g., one RM per subintegration, of shape (nsub,)).
+
+    Returns derotated arrays Q and U.
+    """
+    rm = np.asarray(rm, dtype=np.float64)[..., np.newaxis, np.newaxis]
+    angle = -2*rm*(lambda_squared(freq) - lam2_ref)[:, np.newaxis]
+    dtype = np.result_type(Q, U, np.float32)
+    cos = np.cos(angle).astype(dtype, copy=False)
+    sin = np.sin(angle).astype(dtype, copy=False)
+    return Q*cos - U*sin, Q*sin + U*cos
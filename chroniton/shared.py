@@ -0,0 +1,186 @@
+import os
+import sys
+import tempfile
+import weakref
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from .portrait import Portrait
+
+def _stokes_arrays(obj):
+    if obj.full_stokes:
+        return [obj.I, obj.Q, obj.U, obj.V]
+    else:
+        return [obj.I]
+
+def _attach_shm(name):
+    # Attaching workers must never unlink the block; only its creator does.
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    shm = SharedMemory(name=name)
+    # Undo the registration with the resource tracker, which would otherwise
+    # unlink the block (or warn about a leak) when this process exits
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+def _release_shm(shm):
+    shm.close()
+    if sys.version_info < (3, 13):
+        # Attached processes sharing our resource tracker may have removed
+        # the registration; restore it so that unlink() can remove it cleanly
+        resource_tracker.register(shm._name, 'shared_memory')
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+def _release_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class SharedStokes:
+    def __init__(self, obj, backing='shm', directory=None):
+        """
+        Copy the Stokes parameters of a Portrait or Observation into a single
+        block of shared memory, from which worker processes can attach
+        zero-copy views of the data.
+
+        The block is released when `close()` is called, when the context
+        manager exits, or when this object is garbage collected. If the
+        creating process dies, shared memory blocks are unlinked by the
+        multiprocessing resource tracker; memory-mapped scratch files are
+        left in `directory`. A worker that crashes only loses its own mapping.
+
+        Parameters
+        ----------
+        obj: Portrait or Observation whose data should be shared.
+        backing: 'shm' to use `multiprocessing.shared_memory`, or 'memmap'
+                 to use a memory-mapped scratch file.
+        directory: Directory in which to create the scratch file
+                   (only used if `backing` is 'memmap').
+        """
+        arrays = _stokes_arrays(obj)
+        dtype = np.result_type(*arrays)
+        shape = (len(arrays),) + obj.shape
+        nbytes = int(np.prod(shape))*dtype.itemsize
+
+        if backing == 'shm':
+            self._shm = SharedMemory(create=True, size=max(nbytes, 1))
+            location = self._shm.name
+            block = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+            self._finalizer = weakref.finalize(self, _release_shm, self._shm)
+        elif backing == 'memmap':
+            fd, location = tempfile.mkstemp(dir=directory, prefix='chroniton-', suffix='.dat')
+            os.close(fd)
+            self._finalizer = weakref.finalize(self, _release_file, location)
+            block = np.memmap(location, dtype=dtype, mode='w+', shape=shape)
+        else:
+            raise ValueError(f"Unrecognized backing '{backing}'.")
+
+        for i, arr in enumerate(arrays):
+            block[i] = arr
+        if backing == 'memmap':
+            block.flush()
+        del block
+
+        meta = {'freq': obj.freq, 'weights': obj.weights}
+        if hasattr(obj, 'epochs'):
+            meta['epochs'] = obj.epochs
+            meta['period'] = obj.period
+        self.handle = SharedHandle(type(obj), backing, location, shape, dtype, meta)
+
+    def close(self):
+        """
+        Release the shared block. Views attached by workers must already
+        have been detached.
+        """
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class SharedHandle:
+    def __init__(self, cls, backing, location, shape, dtype, meta):
+        """
+        A lightweight, picklable reference to data held by a SharedStokes
+        object. Pass this to worker processes and call `attach()` there.
+        """
+        self.cls = cls
+        self.backing = backing
+        self.location = location
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.meta = meta
+
+    def attach(self, subint=slice(None), chan=slice(None), writeable=False):
+        """
+        Attach to the shared data, returning an `AttachedStokes` context
+        manager whose `obj` attribute is a Portrait or Observation with
+        views (not copies) of the selected subintegrations and channels.
+        Integer indices select a single subintegration or channel and drop
+        that axis, as with ordinary array indexing; selecting a single
+        subintegration of an Observation yields a Portrait.
+
+        Parameters
+        ----------
+        subint: Index or slice of subintegrations (Observations only).
+        chan: Index or slice of channels.
+        writeable: Whether the returned views may be modified in place.
+        """
+        return AttachedStokes(self, subint, chan, writeable)
+
+class AttachedStokes:
+    def __init__(self, handle, subint, chan, writeable):
+        if handle.backing == 'shm':
+            shm = _attach_shm(handle.location)
+            block = np.ndarray(handle.shape, dtype=handle.dtype, buffer=shm.buf)
+            # All views of the data keep `block` alive, so the segment is
+            # unmapped only once none of them remain
+            weakref.finalize(block, shm.close).atexit = False
+        else:
+            mode = 'r+' if writeable else 'r'
+            block = np.memmap(handle.location, dtype=handle.dtype, mode=mode, shape=handle.shape)
+
+        meta = handle.meta
+        if 'epochs' in meta:
+            views = block[:, subint, chan]
+            weights = meta['weights'][subint, chan]
+            period = meta['period']
+            if period is not None:
+                period = period[subint]
+            epochs = meta['epochs'][subint]
+        else:
+            views = block[:, chan]
+            weights = meta['weights'][chan]
+        views = views.view()
+        views.flags.writeable = writeable
+        freq = meta['freq'][chan]
+
+        if 'epochs' in meta and np.ndim(epochs) == 0:
+            self.obj = Portrait(freq, *views, weights=weights)
+        elif 'epochs' in meta:
+            self.obj = handle.cls(epochs, freq, *views, period=period, weights=weights)
+        else:
+            self.obj = handle.cls(freq, *views, weights=weights)
+
+    def detach(self):
+        """
+        Drop the object holding views of the shared data. The data are
+        unmapped from this process once no views of them remain, so arrays
+        taken from the object (e.g., `obj.I`) stay valid for as long as
+        they are referenced.
+        """
+        self.obj = None
+
+    def __enter__(self):
+        return self.obj
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.detach()
@@ -0,0 +1,204 @@
+import numpy as np
+import scipy.fft
+from astropy.io import fits
+import astropy.units as u
+from astropy.time import Time
+
+from .observation import Observation
+from .psrfits import PsrfitsWriter
+from .pipeline import prefetch
+
+# Dispersion constant, in MHz**2 pc**-1 cm**3 s
+DM_CONST = 4.148808e3
+
+def _stokes_to_products(stokes, pol_type, feed_poln):
+    # Inverse of coherence_to_stokes(), and selection of total intensity
+    if pol_type in ('AA+BB', 'INTEN'):
+        return stokes[:1]
+    elif pol_type == 'IQUV':
+        return stokes
+    elif pol_type == 'AABBCRCI':
+        I, Q, U, V = stokes
+        if feed_poln == 'LIN':
+            return np.stack([(I + Q)/2, (I - Q)/2, U/2, V/2])
+        elif feed_poln == 'CIRC':
+            return np.stack([(I + V)/2, (I - V)/2, Q/2, U/2])
+        else:
+            raise ValueError(f"Unrecognized feed polarization '{feed_poln}'.")
+    else:
+        raise ValueError(f"Unrecognized polarization type '{pol_type}'.")
+
+class Simulator:
+    def __init__(self, template, freq, nsub, period=0.005*u.s, tsubint=10*u.s,
+                 start_time=Time(60000, format='pulsar_mjd'), pol_type='IQUV', feed_poln='LIN',
+                 toa_offsets=0.0, dm=0.0, ref_freq=None, amplitude=1.0, noise=0.05,
+                 zapped=(), seed=None):
+        """
+        Generate synthetic fold-mode observations: a template profile,
+        rotated in each subint and channel by an injected TOA offset plus
+        a dispersive delay, scaled, and with white noise added. The data
+        are generated one subint at a time, from an independent random
+        stream per subint, so any subint can be regenerated on its own and
+        files of any size can be written without holding them in memory.
+
+        Parameters
+        ----------
+        template: Profile to inject (total intensity or full Stokes).
+        freq: Channel frequencies (Astropy Quantity).
+        nsub: Number of subintegrations.
+        period: Folding period (Astropy Quantity).
+        tsubint: Length of each subint (Astropy Quantity).
+        start_time: Start time of the observation (astropy Time).
+        pol_type: Polarization type to produce: 'AA+BB', 'IQUV', or 'AABBCRCI'.
+        feed_poln: Feed polarization ('LIN' or 'CIRC'), used for 'AABBCRCI'.
+        toa_offsets: Injected TOA offsets (in bins), broadcast to (nsub, nchan).
+        dm: Dispersion measure (pc cm**-3) of the injected delays.
+        ref_freq: Frequency at which the dispersive delay is zero
+                  (Astropy Quantity); by default, the highest frequency.
+        amplitude: Scale factor applied to the template, broadcast to (nsub, nchan).
+        noise: Standard deviation of the noise added to each Stokes
+               parameter (or product), per bin.
+        zapped: Indices of channels to give zero weight.
+        seed: Seed for the random number generator.
+        """
+        self.template = template
+        self.freq = freq
+        self.nsub = nsub
+        self.nchan = len(freq)
+        self.nbin = template.nbin
+        self.period = period
+        self.tsubint = tsubint
+        self.start_time = start_time
+        self.pol_type = pol_type.upper()
+        self.feed_poln = feed_poln.upper()
+        if self.pol_type not in ('AA+BB', 'INTEN', 'IQUV', 'AABBCRCI'):
+            raise ValueError(f"Unrecognized polarization type '{pol_type}'.")
+        if self.pol_type in ('IQUV', 'AABBCRCI') and not template.full_stokes:
+            raise ValueError(f"Polarization type '{pol_type}' requires a full Stokes template.")
+        self.npol = 1 if self.pol_type in ('AA+BB', 'INTEN') else 4
+        self.dm = dm
+        self.noise = noise
+        self.seed = np.random.SeedSequence(seed)
+
+        if ref_freq is None:
+            ref_freq = np.max(freq)
+        self.ref_freq = ref_freq
+        delay = DM_CONST*dm*((freq.to_value(u.MHz))**-2 - ref_freq.to_value(u.MHz)**-2)
+        self.dm_delay = delay/period.to_value(u.s)*self.nbin
+        self.toa_offsets = np.broadcast_to(toa_offsets, (nsub, self.nchan)).astype(np.float64)
+        self.amplitude = np.broadcast_to(amplitude, (nsub, self.nchan)).astype(np.float64)
+        self.weights = np.ones((nsub, self.nchan), dtype=np.float32)
+        self.weights[:, list(zapped)] = 0
+
+        stokes = [template.I, template.Q, template.U, template.V] if template.full_stokes else [template.I]
+        self._template_rfft = scipy.fft.rfft(np.array(stokes[:self.npol]))
+        self._seeds = self.seed.spawn(nsub)
+
+    @property
+    def true_shifts(self):
+        """
+        Total injected shift (TOA offset plus dispersive delay), in bins,
+        of each subint and channel: the TOA that `make_toas()` should
+        recover with the injected template.
+        """
+        return self.toa_offsets + self.dm_delay
+
+    @property
+    def epochs(self):
+        """
+        Epoch (midpoint) of each subint.
+        """
+        return self.start_time + self.offs_sub*u.s
+
+    @property
+    def offs_sub(self):
+        """
+        Epoch of each subint relative to the start time, in seconds.
+        """
+        return (np.arange(self.nsub) + 0.5)*self.tsubint.to_value(u.s)
+
+    def subint(self, isub, dtype=np.float32):
+        """
+        Generate the data of subint `isub`, of shape (npol, nchan, nbin),
+        with polarization products in the order given by the polarization type.
+        """
+        shifts = self.true_shifts[isub]
+        ramp = np.exp(-2j*np.pi*shifts[:, np.newaxis]*scipy.fft.rfftfreq(self.nbin))
+        spectra = self._template_rfft[:, np.newaxis, :]*ramp*self.amplitude[isub, :, np.newaxis]
+        stokes = scipy.fft.irfft(spectra, self.nbin)
+        if self.npol == 4:
+            stokes = _stokes_to_products(stokes, self.pol_type, self.feed_poln)
+        rng = np.random.default_rng(self._seeds[isub])
+        data = rng.standard_normal(stokes.shape, dtype=np.float32).astype(dtype, copy=False)
+        data *= self.noise
+        data += stokes
+        data[:, self.weights[isub] == 0] = 0
+        return data
+
+    def observation(self, dtype=np.float32):
+        """
+        Generate the whole observation in memory, as an Observation.
+        """
+        data = np.stack([self.subint(isub, dtype) for isub in range(self.nsub)], axis=1)
+        if self.pol_type == 'AABBCRCI':
+            from .polarization import coherence_to_stokes
+            data = np.stack(coherence_to_stokes(*data, self.feed_poln))
+        period = np.full(self.nsub, self.period.to_value(u.s))*u.s
+        return Observation(self.epochs, self.freq, *data, period=period, weights=self.weights)
+
+    def truth(self):
+        """
+        The injected parameters, as a dictionary of arrays.
+        """
+        return {
+            'toa_offsets': self.toa_offsets,
+            'dm_delay': self.dm_delay,
+            'true_shifts': self.true_shifts,
+            'amplitude': self.amplitude,
+            'weights': self.weights,
+            'dm': self.dm,
+            'ref_freq': self.ref_freq.to_value(u.MHz),
+            'noise': self.noise,
+        }
+
+    def write(self, filename, requantize=True, overwrite=False, max_workers=2):
+        """
+        Write the observation to a PSRFITS file, one subint at a time, with
+        up to `max_workers` subints being generated in background threads
+        while earlier ones are written. The
+        injected truth is recorded in an extra 'SIM_TRUTH' table (with the
+        TOA offset, dispersive delay, total shift, and amplitude of each
+        subint and channel, in bins) whose header holds the DM, reference
+        frequency, noise level, and seed.
+        """
+        primary_header = fits.Header()
+        primary_header['TELESCOP'] = 'SIMULATED'
+        primary_header['FD_POLN'] = self.feed_poln
+        primary_header['OBSFREQ'] = float(np.mean(self.freq.to_value(u.MHz)))
+        primary_header['OBSBW'] = float(np.ptp(self.freq.to_value(u.MHz)))
+        subint_header = fits.Header()
+        subint_header['DM'] = self.dm
+        subint_header['TBIN'] = self.period.to_value(u.s)/self.nbin
+
+        shape = (self.npol, self.nchan, self.nbin)
+        with PsrfitsWriter(filename, self.nsub, *shape, self.pol_type, self.start_time,
+                           primary_header, subint_header, requantize=requantize,
+                           overwrite=overwrite) as writer:
+            subints = prefetch(self.subint, range(self.nsub), depth=max_workers)
+            for isub, data in subints:
+                writer.write_subint(data, self.offs_sub[isub], self.freq,
+                                    self.weights[isub], self.period, self.tsubint.to_value(u.s))
+
+        nchan = self.nchan
+        truth = fits.BinTableHDU.from_columns([
+            fits.Column(name='TOA_OFFSET', format=f'{nchan}D', array=self.toa_offsets),
+            fits.Column(name='DM_DELAY', format=f'{nchan}D',
+                        array=np.broadcast_to(self.dm_delay, (self.nsub, nchan))),
+            fits.Column(name='TRUE_SHIFT', format=f'{nchan}D', array=self.true_shifts),
+            fits.Column(name='AMPLITUDE', format=f'{nchan}D', array=self.amplitude),
+        ], name='SIM_TRUTH')
+        truth.header['DM'] = self.dm
+        truth.header['REF_FREQ'] = self.ref_freq.to_value(u.MHz)
+        truth.header['NOISE'] = self.noise
+        truth.header['SEED'] = str(self.seed.entropy)
+        fits.append(filename, truth.data, truth.header)
@@ -0,0 +1,225 @@
+import copy
+import numpy as np
+import scipy.fft
+
+from .utils import is_lazy, fft_roll, fft_resample
+
+def _roll_block(block, shift):
+    # Rotate one chunk of a dask array; `shift` has a trailing axis of length 1
+    return fft_roll(block, shift[..., 0])
+
+class StokesArray:
+    """
+    Descriptor for a Stokes parameter array (I, Q, U, or V) which discards
+    the cached spectrum and plotting data of that parameter, and any cached
+    polarization products, whenever it is reassigned.
+    Augmented assignment (e.g., `portrait.I /= 2`) counts as reassignment.
+    """
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            return obj.__dict__['_' + self.name]
+        except KeyError:
+            raise AttributeError(
+                f"'{type(obj).__name__}' object has no attribute '{self.name}'"
+            ) from None
+
+    def __set__(self, obj, value):
+        obj.__dict__['_' + self.name] = value
+        obj.__dict__.setdefault('_spectra', {}).pop(self.name, None)
+        obj.__dict__.setdefault('_plot_views', {}).pop(self.name, None)
+        obj.__dict__.pop('_polarization', None)
+
+class SpectrumCache:
+    """
+    Mixin for classes holding Stokes parameters I, Q, U, and V, with pulse
+    phase along the last axis. The rFFT of each parameter along the phase
+    axis is computed on first use and cached.
+
+    Reassigning a parameter invalidates its cached spectrum automatically.
+    Code that modifies the arrays in place by item assignment (e.g.,
+    `portrait.I[0] = 0`) must call `invalidate_spectra()` afterwards.
+    """
+    I = StokesArray()
+    Q = StokesArray()
+    U = StokesArray()
+    V = StokesArray()
+
+    def spectrum(self, what='I'):
+        """
+        Return the (cached) rFFT of Stokes parameter `what` along the phase axis.
+        For chunked (dask) arrays, the spectrum is itself a dask array.
+        """
+        spectra = self.__dict__.setdefault('_spectra', {})
+        if what not in spectra:
+            arr = getattr(self, what)
+            if is_lazy(arr):
+                # Keep the spectrum of a chunked array lazy as well
+                nfreq = arr.shape[-1]//2 + 1
+                spectra[what] = arr.map_blocks(
+                    scipy.fft.rfft,
+                    chunks=arr.chunks[:-1] + ((nfreq,),),
+                    dtype=np.result_type(arr.dtype, np.complex64),
+                )
+            else:
+                spectra[what] = scipy.fft.rfft(arr)
+        return spectra[what]
+
+    def cached_spectrum(self, what='I'):
+        """
+        Return the cached rFFT of Stokes parameter `what` if it has already
+        been computed, or `None` otherwise. Unlike `spectrum()`, this never
+        computes (or caches) a spectrum.
+        """
+        return self.__dict__.get('_spectra', {}).get(what)
+
+    def invalidate_spectra(self, what=None):
+        """
+        Discard the cached spectrum (and any data cached for plotting) of
+        Stokes parameter `what`, or of all parameters if `what` is `None`.
+        """
+        spectra = self.__dict__.setdefault('_spectra', {})
+        views = self.__dict__.setdefault('_plot_views', {})
+        if what is None:
+            spectra.clear()
+            views.clear()
+        else:
+            spectra.pop(what, None)
+            views.pop(what, None)
+
+    def shifted(self, what='I', shift=0.0):
+        """
+        Return Stokes parameter `what` rotated by `shift` bins (as with
+        `fft_roll()`), using the cached spectrum. `shift` may be an array
+        broadcast against the leading axes of the data.
+        """
+        spectrum = self.spectrum(what)
+        shift = np.asarray(shift)[..., np.newaxis]
+        phase = -2j*np.pi*shift*scipy.fft.rfftfreq(self.nbin)
+        ramp = np.exp(phase).astype(spectrum.dtype, copy=False)
+        return scipy.fft.irfft(spectrum*ramp, self.nbin)
+
+class StokesOperations:
+    """
+    Mixin providing operations along the phase axis for classes holding
+    Stokes parameters I, Q, U, and V (see `SpectrumCache`). Each operation
+    is applied to every profile in one call, either in place or to a copy.
+    """
+    def _stokes_names(self):
+        return ['I', 'Q', 'U', 'V'] if self.full_stokes else ['I']
+
+    def _with_stokes(self, stokes, inplace):
+        # Set the Stokes parameters of `self` (or of a shallow copy without
+        # any cached quantities), updating the phase-axis attributes
+        if inplace:
+            obj = self
+        else:
+            obj = copy.copy(self)
+            for key in ('_spectra', '_plot_views', '_polarization'):
+                obj.__dict__.pop(key, None)
+        for name, arr in zip(self._stokes_names(), stokes):
+            setattr(obj, name, arr)
+        obj.shape = stokes[0].shape
+        obj.nbin = obj.shape[-1]
+        if 'phase' in obj.__dict__:
+            obj.phase = np.linspace(0, 1, obj.nbin, endpoint=False)
+        return None if inplace else obj
+
+    def normalize(self, inplace=True):
+        """
+        Scale each profile to a maximum amplitude of unity in I. Profiles
+        with no positive values (e.g., those with zero weight) are left
+        unchanged. Returns a new object if `inplace` is `False`.
+        """
+        I_max = self.I.max(axis=-1, keepdims=True)
+        scale = np.where(I_max > 0, I_max, 1).astype(self.I.dtype)
+        if not inplace:
+            return self._with_stokes([getattr(self, name)/scale for name in self._stokes_names()],
+                                     inplace=False)
+        for name in self._stokes_names():
+            arr = getattr(self, name)
+            if is_lazy(arr):
+                arr = arr/scale
+            else:
+                arr /= scale
+            setattr(self, name, arr)
+
+    def make_posdef(self, fudge_factor=1.5, inplace=True):
+        """
+        Add a small constant to the squared total intensity of each profile,
+        to make sure its squared invariant interval (I**2 - Q**2 - U**2 - V**2)
+        is positive. Returns a new object if `inplace` is `False`.
+
+        Parameters
+        ----------
+        fudge_factor: Overcompensate by this factor, so as to avoid
+                      having the invariant interval equal to zero at
+                      the phase where it is minimized.
+        """
+        squared_norm = self.I**2
+        if self.full_stokes:
+            squared_norm = squared_norm - self.Q**2 - self.U**2 - self.V**2
+        adjustment = np.maximum(-squared_norm.min(axis=-1, keepdims=True), 0)*fudge_factor
+        I = np.sqrt(self.I**2 + adjustment)
+        stokes = [I] + [getattr(self, name) for name in self._stokes_names()[1:]]
+        return self._with_stokes(stokes, inplace)
+
+    def resample(self, nbin, inplace=False):
+        """
+        Resample every profile to a given number of phase bins, as with
+        scipy.signal.resample(). All Stokes parameters are transformed
+        together, reusing cached spectra where available. Returns a new
+        object unless `inplace` is `True`.
+        """
+        names = self._stokes_names()
+        if is_lazy(self.I):
+            stokes = [getattr(self, name).map_blocks(
+                fft_resample, nbin, chunks=getattr(self, name).chunks[:-1] + ((nbin,),),
+            ) for name in names]
+        else:
+            spectra = self.__dict__.get('_spectra', {})
+            if all(name in spectra for name in names):
+                spectrum = np.stack([spectra[name] for name in names])
+            else:
+                spectrum = scipy.fft.rfft(np.stack([getattr(self, name) for name in names]))
+            stokes = list(fft_resample(self.I, nbin, spectrum=spectrum))
+        return self._with_stokes(stokes, inplace)
+
+    def rotate(self, shift, inplace=False):
+        """
+        Rotate every profile by `shift` bins (as with `fft_roll()`), where
+        `shift` is broadcast against the leading axes of the data (e.g., one
+        shift per subintegration, of shape (nsub, 1)). All Stokes parameters
+        are rotated in one pass over their stacked spectra, reusing cached
+        spectra where available, and the spectra of the result are cached.
+        Returns a new object unless `inplace` is `True`.
+        """
+        names = self._stokes_names()
+        shift = np.broadcast_to(np.asarray(shift, dtype=np.float64), self.shape[:-1])
+        if is_lazy(self.I):
+            import dask.array as da
+            shift = da.from_array(shift[..., np.newaxis], chunks=self.I.chunks[:-1] + ((1,),))
+            stokes = [da.map_blocks(_roll_block, getattr(self, name), shift,
+                                    dtype=getattr(self, name).dtype) for name in names]
+            return self._with_stokes(stokes, inplace)
+
+        spectra = self.__dict__.get('_spectra', {})
+        if all(name in spectra for name in names):
+            spectrum = np.stack([spectra[name] for name in names])
+        else:
+            spectrum = scipy.fft.rfft(np.stack([getattr(self, name) for name in names]))
+        ramp = np.exp(-2j*np.pi*shift[..., np.newaxis]*scipy.fft.rfftfreq(self.nbin))
+        spectrum *= ramp.astype(spectrum.dtype, copy=False)
+        # The DC and Nyquist terms of a real signal are real, and irfft()
+        # discards their imaginary parts, so drop them here as well to keep
+        # the cached spectra consistent with the rotated data
+        spectrum[..., 0] = spectrum[..., 0].real
+        if self.nbin % 2 == 0:
+            spectrum[..., -1] = spectrum[..., -1].real
+        obj = self._with_stokes(list(scipy.fft.irfft(spectrum, self.nbin)), inplace)
+        (self if inplace else obj).__dict__['_spectra'] = dict(zip(names, spectrum))
+        return obj
@@ -5,6 +5,7 @@ import astropy.units as u
 import pickle
 
 from .portrait import Portrait
+from .utils import fft_roll
 
 class SplineModel:
     def __init__(self, mean_prof, eigvec, tck):
@@ -57,7 +58,7 @@ class SplineModel:
             port = np.broadcast_to(self.mean_prof, (freqs.size, self.mean_prof.size))
             port = port.copy()
         if nbin is not None and (nbin != self.mean_prof.shape[-1]):
-            shift = 0.5 * (nbin**-1 - len(mean_prof)**-1)
-            port = scipy.signal.resample(port, nbin, axis=1)
-            port = rotate_portrait(port, shift) #resample introduces shift!
+            shift = 0.5 * (nbin**-1 - len(self.mean_prof)**-1)
+            port = resample(port, nbin, axis=1)
+            port = fft_roll(port, -shift*nbin) #resample introduces shift!
         return Portrait(freqs, port)
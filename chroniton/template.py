@@ -0,0 +1,279 @@
+import functools
+from collections import namedtuple
+
+import numpy as np
+import scipy.fft
+
+from .observation import Observation
+from .profile import Profile
+from .toas import toa_fourier_batch, ToaResult
+from .utils import offpulse_rms, chunk_length
+from .pipeline import prefetch
+
+def scrunch(obj, loader=Observation.from_file):
+    """
+    Average an Observation, Portrait, or Profile (or a file name, which is
+    loaded with `loader`) down to a single profile, weighting each
+    subintegration and channel by its weight. The data are assumed to be
+    dedispersed. Returns an array of shape (npol, nbin) and the total weight.
+    """
+    if isinstance(obj, str):
+        obj = loader(obj)
+    if hasattr(obj, 'avg_portrait'):
+        obj = obj.avg_portrait()
+    stokes = [obj.I, obj.Q, obj.U, obj.V] if obj.full_stokes else [obj.I]
+    stokes = np.array(stokes, dtype=np.float64)
+    if stokes.ndim == 2:
+        # Already a Profile
+        return stokes, 1.0
+    weights = np.asarray(obj.weights, dtype=np.float64)
+    total = np.sum(weights)
+    if total == 0:
+        return np.zeros(stokes.shape[::2]), 0.0
+    profile = np.einsum('c,pcb->pb', weights, np.nan_to_num(stokes))/total
+    return profile, total
+
+def _denoise(spectrum, nharm, noise_power):
+    # Keep harmonics up to `nharm`, or (if 'auto') up to the last harmonic
+    # before the power of the average first drops below the noise level
+    if nharm is None:
+        return spectrum
+    if nharm == 'auto':
+        power = np.abs(spectrum[0])**2
+        below = np.nonzero(power[1:] < noise_power)[0]
+        nharm = below[0] if below.size else power.size - 1
+    spectrum = spectrum.copy()
+    spectrum[:, nharm + 1:] = 0
+    return spectrum
+
+def build_template(data, template=None, max_iter=20, tol=1e-3, nharm=None,
+                   max_workers=None, loader=Observation.from_file):
+    """
+    Build a template profile by iteratively aligning and averaging many
+    observations. Each input is first averaged to a single profile (in
+    parallel, with at most `max_workers` inputs in memory at once). Then,
+    in each iteration, the TOAs of all profiles against the current
+    template are found in one batched calculation, every profile is
+    rotated into alignment by multiplying its spectrum by a phase ramp,
+    and the new template is the average of the aligned spectra, weighted
+    by the input weights and the inverse off-pulse noise variance. The
+    mean shift is removed in each iteration, so the template stays
+    aligned with the initial one. Iteration stops when no shift changes
+    by more than `tol` bins.
+
+    Parameters
+    ----------
+    data: Observations, Portraits, Profiles, or PSRFITS file names
+          (all with the same number of bins and Stokes parameters).
+    template: Initial template (Profile). If `None`, the input profile
+              with the highest peak S/N is used.
+    max_iter: Maximum number of iterations.
+    tol: Convergence tolerance on the shifts (in bins).
+    nharm: Number of harmonics to keep in the template, to suppress noise;
+           'auto' to keep harmonics until the first one whose power falls
+           below the expected noise power; or `None` for no smoothing.
+    max_workers: Number of threads used to load and average the inputs.
+    loader: Function used to load inputs given as file names.
+
+    Returns a Profile, normalized to a peak of unity in I.
+    """
+    depth = max_workers or 1
+    scrunched = [result for _, result in prefetch(
+        functools.partial(scrunch, loader=loader), data, depth=depth, max_workers=max_workers
+    )]
+    profiles = np.array([profile for profile, _ in scrunched])
+    weights = np.array([weight for _, weight in scrunched])
+    if profiles.size == 0:
+        raise ValueError("No data from which to build a template.")
+    nbin = profiles.shape[-1]
+
+    noise = np.asarray(offpulse_rms(profiles[:, 0], nbin//4))
+    usable = (weights > 0) & (noise > 0)
+    noise = np.where(usable, noise, 1)
+    weights = np.where(usable, weights/noise**2, 0)
+    if not np.any(weights > 0):
+        raise ValueError("All input profiles have zero weight.")
+
+    spectra = scipy.fft.rfft(profiles)
+    freqs = scipy.fft.rfftfreq(nbin)
+    if template is None:
+        peak_snr = np.where(usable, np.max(profiles[:, 0], axis=-1)/noise, -np.inf)
+        template_spectrum = spectra[np.argmax(peak_snr)]
+    else:
+        if template.nbin != nbin:
+            raise ValueError(f"Template has {template.nbin} bins, but data have {nbin}.")
+        template_spectrum = scipy.fft.rfft(np.array(
+            [template.I, template.Q, template.U, template.V]
+            if template.full_stokes and profiles.shape[1] == 4 else [template.I]
+        ))
+
+    # Expected noise power per harmonic of the weighted average of spectra
+    noise_power = nbin*np.sum((weights*noise)**2)/np.sum(weights)**2
+
+    shifts = np.zeros(len(profiles))
+    for _ in range(max_iter):
+        result = toa_fourier_batch(scipy.fft.irfft(template_spectrum[0], nbin), profiles[:, 0],
+                                   template_rfft=template_spectrum[0],
+                                   profile_rfft=spectra[:, 0], noise_level=noise)
+        new_shifts = np.where(weights > 0, np.nan_to_num(result.toa), 0)
+        new_shifts -= np.sum(weights*new_shifts)/np.sum(weights)
+
+        ramp = np.exp(2j*np.pi*new_shifts[:, np.newaxis]*freqs)
+        average = np.einsum('n,npk,nk->pk', weights, spectra, ramp)/np.sum(weights)
+        template_spectrum = _denoise(average, nharm, noise_power)
+
+        converged = np.max(np.abs(new_shifts - shifts)) < tol
+        shifts = new_shifts
+        if converged:
+            break
+
+    template = Profile(*scipy.fft.irfft(template_spectrum, nbin))
+    template.normalize()
+    return template
+
+MatchResult = namedtuple('MatchResult', ['index', 'corr'] + list(ToaResult._fields))
+
+class TemplateLibrary:
+    def __init__(self, templates, names=None):
+        """
+        A set of alternative templates (e.g., one per emission mode of a
+        mode-changing pulsar), against which profiles are matched to pick
+        the best template for each. Template spectra and norms are computed
+        once, when the library is created.
+
+        Parameters
+        ----------
+        templates: A sequence of Profiles, or an array of shape (ntemp, ..., nbin),
+                   where any middle axes are broadcast against the leading
+                   axes of the data (e.g., (ntemp, nchan, nbin) for one
+                   template profile per channel).
+        names: Names of the templates (optional).
+        """
+        templates = np.array([getattr(t, 'I', t) for t in templates], dtype=np.float64)
+        if templates.ndim < 2 or len(templates) == 0:
+            raise ValueError("A template library needs at least one template profile.")
+        self.ntemp = len(templates)
+        self.nbin = templates.shape[-1]
+        self.names = list(names) if names is not None else [str(i) for i in range(self.ntemp)]
+        if len(self.names) != self.ntemp:
+            raise ValueError(f"Got {len(self.names)} names for {self.ntemp} templates.")
+
+        # Template index along the second-to-last axis, so that the
+        # templates broadcast against profiles of shape (..., 1, nbin)
+        self.templates = np.moveaxis(templates, 0, -2)
+        self.spectra = scipy.fft.rfft(self.templates)
+        centered = self.templates - self.templates.mean(axis=-1, keepdims=True)
+        norms = np.sqrt(np.sum(centered**2, axis=-1))
+        if np.any(norms == 0):
+            raise ValueError("Templates must not be constant.")
+        # Conjugate spectra of the mean-subtracted templates, scaled to unit norm
+        self._ccf_spectra = np.conj(self.spectra)/norms[..., np.newaxis]
+        self._ccf_spectra[..., 0] = 0
+
+    def match(self, profiles, profile_rfft=None, noise_level=None, chunk_size=None,
+              tol=np.sqrt(np.finfo(np.float64).eps)):
+        """
+        Find the best-matching template for each of a stack of profiles,
+        and its TOA. The circular cross-correlations of every profile with
+        every template are computed in one Fourier-domain pass (in chunks),
+        and the template giving the highest peak correlation coefficient
+        (found by parabolic interpolation around the CCF maximum) is
+        selected. The TOA, amplitude, and S/N against the selected template
+        are then found as in `toa_fourier_batch()`.
+
+        Parameters
+        ----------
+        profiles: Data profiles, of shape (..., nbin), or a Portrait or
+                  Observation (whose spectrum of I is reused if it is
+                  already cached, and whose profiles with zero weight
+                  are skipped).
+        profile_rfft: `scipy.fft.rfft(profiles)`, if already computed.
+                      Otherwise, only the profiles that are matched are
+                      transformed, chunk by chunk.
+        noise_level: Off-pulse noise of each profile (see `toa_fourier_batch()`).
+        chunk_size: Number of entries along the first axis of the data to
+                    process at once. By default, this is chosen from the
+                    size of the cross-correlations (see `chunk_length()`).
+        tol: Absolute tolerance for the TOAs (in bins).
+
+        Returns a MatchResult whose fields are arrays with the broadcast
+        shape of the profiles and templates, without the last axis: the
+        index of the best template, its correlation coefficient with the
+        profile (after removing the means), and the TOA, error, amplitude,
+        and S/N against it. Skipped profiles have index -1 and NaN results.
+        """
+        if profile_rfft is None and hasattr(profiles, 'cached_spectrum'):
+            profile_rfft = profiles.cached_spectrum('I')
+        weights = getattr(profiles, 'weights', None)
+        profiles = np.asarray(getattr(profiles, 'I', profiles))
+        if profiles.shape[-1] != self.nbin:
+            raise ValueError(f"Templates have {self.nbin} bins, but profiles have {profiles.shape[-1]}.")
+        shape = np.broadcast_shapes(profiles.shape[:-1], self.templates.shape[:-2])
+        profiles = np.broadcast_to(profiles, shape + profiles.shape[-1:])
+        if profile_rfft is not None:
+            profile_rfft = np.broadcast_to(profile_rfft, shape + profile_rfft.shape[-1:])
+        mask = np.broadcast_to(True if weights is None else np.asarray(weights) > 0, shape)
+        if noise_level is not None:
+            noise_level = np.broadcast_to(noise_level, shape)
+
+        fields = {name: np.full(shape, np.nan) for name in MatchResult._fields}
+        fields['index'] = np.full(shape, -1)
+        if len(shape) == 0:
+            chunks = [Ellipsis]
+        else:
+            row_size = self.ntemp*self.nbin*int(np.prod(shape[1:]))
+            chunk_size = chunk_length(row_size, chunk_size)
+            chunks = [slice(start, start + chunk_size) for start in range(0, shape[0], chunk_size)]
+        library = [self.templates, self.spectra, self._ccf_spectra]
+        for chunk in chunks:
+            block_mask = mask[chunk]
+            if self.templates.ndim > 2:
+                # Templates matching the selected profiles
+                library = [np.broadcast_to(arr, shape + arr.shape[-2:])[chunk][block_mask]
+                           for arr in (self.templates, self.spectra, self._ccf_spectra)]
+            block = profiles[chunk][block_mask]
+            if profile_rfft is None:
+                block_rfft = scipy.fft.rfft(block)
+            else:
+                block_rfft = profile_rfft[chunk][block_mask]
+            results = self._match_block(
+                block, block_rfft, *library,
+                None if noise_level is None else noise_level[chunk][block_mask], tol,
+            )
+            for name, values in results.items():
+                fields[name][chunk][block_mask] = values
+        return MatchResult(**fields)
+
+    def _match_block(self, profiles, profile_rfft, templates, spectra, ccf_spectra,
+                     noise_level, tol):
+        # Match profiles of shape (n, nbin) against templates of shape
+        # (ntemp, nbin) or (n, ntemp, nbin)
+        if len(profiles) == 0:
+            return {}
+        ccf_spectra = ccf_spectra.astype(profile_rfft.dtype, copy=False)
+
+        # Correlation of each profile with each template (with their means
+        # removed, and scaled by the template norms), of shape (n, ntemp, nbin)
+        ccf = scipy.fft.irfft(profile_rfft[:, np.newaxis, :]*ccf_spectra, self.nbin)
+        peak = np.argmax(ccf, axis=-1)[..., np.newaxis]
+        y0 = np.take_along_axis(ccf, (peak - 1) % self.nbin, axis=-1)[..., 0]
+        y1 = np.take_along_axis(ccf, peak, axis=-1)[..., 0]
+        y2 = np.take_along_axis(ccf, (peak + 1) % self.nbin, axis=-1)[..., 0]
+        curvature = y0 - 2*y1 + y2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vertex = np.where(curvature < 0, y1 - (y0 - y2)**2/(8*curvature), y1)
+        index = np.argmax(vertex, axis=-1)
+        rows = np.arange(len(index))
+
+        centered = profiles - profiles.mean(axis=-1, keepdims=True)
+        profile_norm = np.sqrt(np.sum(np.asarray(centered, dtype=np.float64)**2, axis=-1))
+        best = vertex[rows, index]
+        corr = np.divide(best, profile_norm, out=np.zeros(best.shape), where=profile_norm > 0)
+
+        # Fit each profile against its selected template
+        templates = np.broadcast_to(templates, (len(rows),) + templates.shape[-2:])
+        spectra = np.broadcast_to(spectra, (len(rows),) + spectra.shape[-2:])
+        result = toa_fourier_batch(templates[rows, index], profiles,
+                                   template_rfft=spectra[rows, index], profile_rfft=profile_rfft,
+                                   noise_level=noise_level, tol=tol)
+        return dict(index=index, corr=corr, **result._asdict())
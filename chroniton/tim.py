@@ -0,0 +1,39 @@
+import numpy as np
+import astropy.units as u
+from pint import PulsarMJD
+
+def tim_lines(names, freqs, mjds, errors, site, flags=None):
+    """
+    Format TOAs as lines of a tempo2-format (FORMAT 1) `.tim` file.
+    All arguments except `site` are broadcast against each other.
+
+    Parameters
+    ----------
+    names: File name(s) to record with each TOA.
+    freqs: Observing frequencies (Astropy Quantity).
+    mjds: Arrival times, as astropy Time objects or full-precision MJD strings.
+    errors: TOA uncertainties (Astropy Quantity).
+    site: Observatory code or name.
+    flags: Dictionary mapping flag names (without the leading '-') to values,
+           which may be scalars or arrays.
+    """
+    if hasattr(mjds, 'pulsar_mjd_string'):
+        mjds = mjds.pulsar_mjd_string
+    if flags is None:
+        flags = {}
+    columns = [
+        names,
+        np.char.mod('%.6f', freqs.to(u.MHz).value),
+        mjds,
+        np.char.mod('%.3f', errors.to(u.us).value),
+        site,
+    ]
+    for name, value in flags.items():
+        columns.append(f"-{name}")
+        columns.append(np.asarray(value).astype(str))
+    columns = np.broadcast_arrays(*(np.asarray(col, dtype=str) for col in columns))
+
+    line_arr = columns[0]
+    for col in columns[1:]:
+        line_arr = np.char.add(np.char.add(line_arr, ' '), col)
+    return line_arr.ravel().tolist()
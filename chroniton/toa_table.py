@@ -0,0 +1,205 @@
+import numpy as np
+import astropy.units as u
+
+from .tim import tim_lines
+
+TOA_DTYPE = np.dtype([
+    ('file', np.int32),
+    ('subint', np.int32),
+    ('chan', np.int32),
+    ('nbin', np.int32),
+    ('freq', np.float64),
+    ('mjd_int', np.int64),
+    ('mjd_frac', np.float64),
+    ('toa', np.float64),
+    ('error', np.float64),
+    ('ampl', np.float64),
+    ('snr', np.float64),
+])
+
+class ToaTable:
+    def __init__(self, data, files=(), sites=(), file_flags=None):
+        """
+        Create a new TOA table from a structured array with dtype `TOA_DTYPE`.
+
+        Each row describes one TOA: the index of the file it came from
+        (`file`), its subintegration and channel indices, the number of
+        phase bins, the channel frequency (MHz), the arrival time as an
+        integer and fractional MJD, the TOA relative to the subintegration
+        epoch (bins), its uncertainty (us), the fitted amplitude, and the S/N.
+        Per-file metadata is kept separately, indexed by the `file` column.
+
+        Parameters
+        ----------
+        data: Structured array of TOAs.
+        files: Names of the files from which the TOAs were derived.
+        sites: Observatory code for each file.
+        file_flags: Dictionary mapping flag names to arrays of per-file values.
+        """
+        self.data = np.asarray(data, dtype=TOA_DTYPE)
+        self.files = np.asarray(files, dtype=str)
+        self.sites = np.asarray(sites, dtype=str)
+        if file_flags is None:
+            file_flags = {}
+        self.file_flags = {name: np.asarray(values, dtype=str)
+                           for name, values in file_flags.items()}
+
+    @classmethod
+    def empty(cls, n, files=(), sites=(), file_flags=None):
+        """
+        Create a table with space for `n` TOAs, to be filled in place.
+        """
+        return cls(np.zeros(n, dtype=TOA_DTYPE), files, sites, file_flags)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        Concatenate several tables into one, renumbering file indices.
+        Per-file flags missing from some of the tables are set to 'unknown'.
+        """
+        tables = list(tables)
+        flag_names = []
+        for table in tables:
+            flag_names.extend(name for name in table.file_flags if name not in flag_names)
+
+        datas = []
+        offset = 0
+        for table in tables:
+            data = table.data.copy()
+            data['file'] += offset
+            datas.append(data)
+            offset += len(table.files)
+
+        files = np.concatenate([table.files for table in tables]) if tables else []
+        sites = np.concatenate([table.sites for table in tables]) if tables else []
+        file_flags = {
+            name: np.concatenate([
+                table.file_flags.get(name, np.full(len(table.files), 'unknown'))
+                for table in tables
+            ])
+            for name in flag_names
+        }
+        data = np.concatenate(datas) if datas else np.zeros(0, dtype=TOA_DTYPE)
+        return cls(data, files, sites, file_flags)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        """
+        Return a column (if `key` is a field name) or a new table
+        containing the selected rows.
+        """
+        if isinstance(key, str):
+            return self.data[key]
+        return ToaTable(np.atleast_1d(self.data[key]), self.files, self.sites, self.file_flags)
+
+    @property
+    def mjd_strings(self):
+        """
+        Full-precision MJD strings for each TOA.
+        """
+        frac = np.char.mod('%.16f', self.data['mjd_frac'])
+        frac = np.char.lstrip(frac, '0')
+        return np.char.add(np.char.mod('%d', self.data['mjd_int']), frac)
+
+    def tim_lines(self, flags=None):
+        """
+        Format the TOAs as lines of a tempo2-format `.tim` file.
+        Per-file flags and the subint, channel, nbin and S/N of each TOA
+        are recorded as flags. Additional flags (with per-row or scalar
+        values) can be supplied in `flags`.
+        """
+        file_idx = self.data['file']
+        row_flags = {name: values[file_idx] for name, values in self.file_flags.items()}
+        row_flags['nbin'] = self.data['nbin']
+        row_flags['subint'] = self.data['subint']
+        row_flags['chan'] = self.data['chan']
+        row_flags['snr'] = np.char.mod('%.2f', self.data['snr'])
+        if flags is not None:
+            row_flags.update(flags)
+        return tim_lines(
+            self.files[file_idx],
+            self.data['freq']*u.MHz,
+            self.mjd_strings,
+            self.data['error']*u.us,
+            self.sites[file_idx],
+            row_flags,
+        )
+
+    def write_tim(self, f, header=True, flags=None):
+        """
+        Write the TOAs to a `.tim` file, given as a path or an open text file.
+        If `header` is `True`, start with a "FORMAT 1" line.
+        """
+        if isinstance(f, str):
+            with open(f, 'w') as fh:
+                return self.write_tim(fh, header=header, flags=flags)
+        if header:
+            f.write("FORMAT 1\n")
+        lines = self.tim_lines(flags)
+        if lines:
+            f.write("\n".join(lines) + "\n")
+
+    def to_arrays(self):
+        """
+        Return the contents of the table as a dictionary of plain arrays,
+        suitable for `np.savez()`.
+        """
+        arrays = {'data': self.data, 'files': self.files, 'sites': self.sites}
+        for name, values in self.file_flags.items():
+            arrays[f"flag_{name}"] = values
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Create a table from a dictionary of arrays like that returned by `to_arrays()`.
+        """
+        file_flags = {key[len('flag_'):]: arrays[key] for key in arrays if key.startswith('flag_')}
+        return cls(arrays['data'], arrays['files'], arrays['sites'], file_flags)
+
+    def save(self, filename):
+        """
+        Save the table to a `.npz` file.
+        """
+        np.savez(filename, **self.to_arrays())
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a table from a `.npz` file written by `save()`.
+        """
+        with np.load(filename, allow_pickle=False) as f:
+            return cls.from_arrays({name: f[name] for name in f.files})
+
+    def to_pint(self, **kwargs):
+        """
+        Convert the table to a PINT `TOAs` object. TOAs from different
+        observatories are loaded separately and merged. Additional keyword
+        arguments are passed to `pint.toa.get_TOAs_array()`.
+        """
+        from pint.toa import get_TOAs_array, merge_TOAs
+
+        file_idx = self.data['file']
+        row_sites = self.sites[file_idx]
+        toa_sets = []
+        for site in np.unique(row_sites):
+            mask = (row_sites == site)
+            rows = self.data[mask]
+            flags = {name: values[file_idx[mask]] for name, values in self.file_flags.items()}
+            flags['name'] = self.files[file_idx[mask]]
+            flags['subint'] = rows['subint']
+            flags['chan'] = rows['chan']
+            flags['snr'] = rows['snr']
+            toa_sets.append(get_TOAs_array(
+                (rows['mjd_int'].astype(np.float64), rows['mjd_frac']),
+                str(site),
+                errors=rows['error']*u.us,
+                freqs=rows['freq']*u.MHz,
+                **flags,
+                **kwargs,
+            ))
+        if len(toa_sets) == 1:
+            return toa_sets[0]
+        return merge_TOAs(toa_sets)
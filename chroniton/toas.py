@@ -1,10 +1,17 @@
 import numpy as np
+import scipy.fft
 from scipy.optimize import minimize_scalar
+try:
+    from scipy.integrate import trapezoid
+except ImportError:
+    # SciPy < 1.6
+    from scipy.integrate import trapz as trapezoid
 from collections import namedtuple
 
-from .utils import fft_roll, offpulse_window, offpulse_rms, rolling_sum
+from .utils import fft_roll, offpulse_window, offpulse_rms, rolling_sum, is_lazy, chunk_length
+from .kernels import get_backend, refine_ccf_peak, refine_ccf_peaks
 
-ToaResult = namedtuple('ToaResult', ['toa', 'error', 'ampl'])
+ToaResult = namedtuple('ToaResult', ['toa', 'error', 'ampl', 'snr'])
 
 def toa_fourier(template, profile, ts = None, noise_level = None, tol = np.sqrt(np.finfo(np.float64).eps)):
     '''
@@ -29,7 +36,9 @@ def toa_fourier(template, profile, ts = None, noise_level = None, tol = np.sqrt(
     profile_fft = np.fft.fft(profile)
     phase_per_bin = -2j*np.pi*np.fft.fftfreq(n)
 
-    circular_ccf = np.fft.irfft(np.fft.rfft(profile)*np.conj(np.fft.rfft(template)), n)
+    profile_rfft = np.fft.rfft(profile)
+    template_rfft = np.fft.rfft(template)
+    circular_ccf = np.fft.irfft(profile_rfft*np.conj(template_rfft), n)
     ccf_argmax = np.argmax(circular_ccf)
     if ccf_argmax > n/2:
         ccf_argmax -= n
@@ -41,8 +50,11 @@ def toa_fourier(template, profile, ts = None, noise_level = None, tol = np.sqrt(
         return ccf.real
 
     brack = (ccf_max - dt, ccf_max, ccf_max + dt)
-    toa = minimize_scalar(lambda tau: -ccf_fourier(tau),
-                          method = 'Brent', bracket = brack, tol = tol*dt).x
+    if get_backend() == 'numba':
+        toa = refine_ccf_peak(profile_rfft, template_rfft, n, ccf_argmax, tol)*dt
+    else:
+        toa = minimize_scalar(lambda tau: -ccf_fourier(tau),
+                              method = 'Brent', bracket = brack, tol = tol*dt).x
 
     assert brack[0] < toa < brack[-1]
 
@@ -54,22 +66,256 @@ def toa_fourier(template, profile, ts = None, noise_level = None, tol = np.sqrt(
         noise_level = offpulse_rms(profile, profile.size//4)
     snr = ampl/noise_level
 
-    w_eff = np.sqrt(n*dt/np.trapz(np.gradient(template, ts)**2, ts))
+    w_eff = np.sqrt(n*dt/trapezoid(np.gradient(template, ts)**2, ts))
     error = w_eff/(snr*np.sqrt(n))
 
-    return ToaResult(toa=toa, error=error, ampl=ampl)
-
-def make_toas(template, portrait):
-    toas = []
-    errs = []
-    ampls = []
-    for port_profile in portrait:
-        pass
-        result = toa_fourier(template.I, port_profile)
-        toas.append(result.toa)
-        errs.append(result.error)
-        ampls.append(result.ampl)
-    toas = np.array(toas)
-    errs = np.array(errs)
-    ampls = np.array(ampls)
-    return toas, errs, ampls
+    return ToaResult(toa=toa, error=error, ampl=ampl, snr=snr)
+
+def toa_fourier_batch(template, profiles, template_rfft=None, profile_rfft=None,
+                      noise_level=None, tol=np.sqrt(np.finfo(np.float64).eps)):
+    """
+    Batched version of `toa_fourier()`. Calculates TOAs (in bins) for a
+    stack of profiles of shape (..., nbin) against templates broadcast
+    against them (e.g., one template of shape (nbin,), or one template per
+    channel of shape (nchan, nbin) for data of shape (nsub, nchan, nbin)).
+    All cross-correlations are computed in a single Fourier-domain pass,
+    and the CCF peaks are refined simultaneously.
+
+    Parameters
+    ----------
+    template: Template profile(s), of shape (..., nbin).
+    profiles: Data profiles, of shape (..., nbin).
+    template_rfft: `scipy.fft.rfft(template)`, if already computed. Supplying
+                   this allows template spectra to be reused across calls.
+    profile_rfft: `scipy.fft.rfft(profiles)`, if already computed.
+    noise_level: Off-pulse noise of each profile. If not supplied, it is
+                 estimated from the off-pulse RMS of each profile.
+    tol: Absolute tolerance for the TOA (in bins).
+
+    Returns a ToaResult whose fields are arrays with the broadcast shape
+    of `template` and `profiles`, without the last axis.
+    """
+    template = np.asarray(template)
+    profiles = np.asarray(profiles)
+    n = profiles.shape[-1]
+    if template.shape[-1] != n:
+        raise ValueError(f"Template has {template.shape[-1]} bins, but profiles have {n}.")
+
+    # The circular CCF is computed in the precision of the data;
+    # refinement, amplitudes, and errors are always in double precision.
+    if profile_rfft is None:
+        profile_rfft = scipy.fft.rfft(profiles)
+    if template_rfft is None:
+        template_rfft = scipy.fft.rfft(template)
+    ccf_template_rfft = template_rfft.astype(profile_rfft.dtype, copy=False)
+    circular_ccf = scipy.fft.irfft(profile_rfft*np.conj(ccf_template_rfft), n)
+    ccf_argmax = np.argmax(circular_ccf, axis=-1)
+    ccf_argmax = np.where(ccf_argmax > n/2, ccf_argmax - n, ccf_argmax)
+    toa = refine_ccf_peaks(profile_rfft, template_rfft, n, ccf_argmax, tol)
+
+    phase = -2j*np.pi*toa[..., np.newaxis]*scipy.fft.rfftfreq(n)
+    template_shifted = scipy.fft.irfft(template_rfft*np.exp(phase), n)
+    b = np.sum(template_shifted*profiles, axis=-1, dtype=np.float64)/np.sum(template**2, axis=-1)
+    ampl = b*np.max(template_shifted, axis=-1)
+    if noise_level is None:
+        noise_level = np.asarray(offpulse_rms(profiles, n//4), dtype=np.float64)
+    snr = ampl/noise_level
+
+    w_eff = np.sqrt(n/trapezoid(np.gradient(template, axis=-1)**2, axis=-1))
+    error = w_eff/(snr*np.sqrt(n))
+
+    return ToaResult(toa=toa, error=error, ampl=ampl, snr=snr)
+
+MonteCarloResult = namedtuple('MonteCarloResult', ['toa', 'error', 'bias'])
+
+def toa_monte_carlo(template, profiles, ntrials=1000, noise_level=None, chunk_size=None,
+                    rng=None, tol=np.sqrt(np.finfo(np.float64).eps)):
+    """
+    Estimate TOA uncertainties empirically. Each profile is first fitted
+    as in `toa_fourier_batch()`; then `ntrials` realizations of white noise
+    at the off-pulse level are added to the fitted model (the template,
+    shifted and scaled), and all of them are refitted together in batches.
+    The spread of the refitted TOAs gives the uncertainty, and their mean
+    offset from the fitted TOA gives the bias. At low S/N, these are more
+    reliable than the analytic uncertainty.
+
+    Parameters
+    ----------
+    template: Template profile(s), of shape (..., nbin).
+    profiles: Data profiles, of shape (..., nbin).
+    ntrials: Number of noise realizations per profile.
+    noise_level: Off-pulse noise of each profile. If not supplied, it is
+                 estimated from the off-pulse RMS of each profile.
+    chunk_size: Number of simulated profiles (over all profiles and
+                realizations) to fit at once. By default, it is set by
+                `chunk_length()`, which keeps memory use independent of
+                the number of profiles and trials.
+    rng: Seed or `numpy.random.Generator` used to generate the noise.
+    tol: Absolute tolerance for the TOA (in bins).
+
+    Returns a MonteCarloResult whose fields (`toa`, `error`, and `bias`,
+    all in bins) are arrays with the broadcast shape of `template` and
+    `profiles`, without the last axis.
+    """
+    template = np.asarray(template)
+    profiles = np.asarray(profiles)
+    n = profiles.shape[-1]
+    shape = np.broadcast_shapes(template.shape, profiles.shape)[:-1]
+    if noise_level is None:
+        noise_level = np.asarray(offpulse_rms(profiles, n//4), dtype=np.float64)
+
+    template_rfft = scipy.fft.rfft(template)
+    fit = toa_fourier_batch(template, profiles, template_rfft=template_rfft,
+                            noise_level=noise_level, tol=tol)
+    phase = -2j*np.pi*fit.toa[..., np.newaxis]*scipy.fft.rfftfreq(n)
+    template_shifted = scipy.fft.irfft(template_rfft*np.exp(phase), n)
+    b = np.sum(template_shifted*profiles, axis=-1, dtype=np.float64)/np.sum(template**2, axis=-1)
+    model = (b[..., np.newaxis]*template_shifted).reshape(-1, n)
+
+    # Flatten everything to one row per profile; realizations go on a new axis
+    nrows = model.shape[0]
+    toa = np.broadcast_to(fit.toa, shape).ravel()
+    sigma = np.broadcast_to(noise_level, shape).ravel()
+    template = np.broadcast_to(template, shape + (n,)).reshape(nrows, 1, n)
+    template_rfft = np.broadcast_to(template_rfft, shape + template_rfft.shape[-1:])
+    template_rfft = template_rfft.reshape(nrows, 1, -1)
+    dtype = np.result_type(profiles.dtype, np.float32)
+    rng = np.random.default_rng(rng)
+    chunk_size = chunk_length(n, chunk_size)
+    # Blocks of whole rows with all their realizations, or, when a single
+    # row has too many realizations, blocks of realizations of one row
+    row_chunk = max(1, chunk_size//max(ntrials, 1))
+    trial_chunk = min(chunk_size, ntrials)
+
+    total = np.zeros(nrows)
+    total_sq = np.zeros(nrows)
+    for row_start in range(0, nrows, row_chunk):
+        rows = slice(row_start, row_start + row_chunk)
+        nr = len(toa[rows])
+        for start in range(0, ntrials, trial_chunk):
+            k = min(trial_chunk, ntrials - start)
+            sims = rng.standard_normal((nr, k, n), dtype=dtype)
+            sims *= sigma[rows, np.newaxis, np.newaxis].astype(dtype)
+            sims += model[rows, np.newaxis, :].astype(dtype)
+            result = toa_fourier_batch(template[rows], sims, template_rfft=template_rfft[rows],
+                                       noise_level=sigma[rows, np.newaxis], tol=tol)
+            offset = (result.toa - toa[rows, np.newaxis] + n/2) % n - n/2
+            total[rows] += np.sum(offset, axis=-1)
+            total_sq[rows] += np.sum(offset**2, axis=-1)
+
+    bias = total/ntrials
+    error = np.sqrt(np.maximum(total_sq/ntrials - bias**2, 0)*ntrials/max(ntrials - 1, 1))
+    return MonteCarloResult(toa=fit.toa, error=error.reshape(shape), bias=bias.reshape(shape))
+
+def template_portrait(template, freq, nbin):
+    """
+    Evaluate a template on a grid of frequencies, returning an array of
+    shape (nbin,) for a Profile, or (nchan, nbin) for a Portrait (which
+    must already match the frequency grid) or a SplineModel (which is
+    evaluated at `freq`).
+    """
+    if hasattr(template, 'make_portrait'):
+        if freq is None:
+            raise ValueError("Frequencies are needed to evaluate a SplineModel template.")
+        return template.make_portrait(freq, nbin).I
+    elif hasattr(template, 'freq'):
+        nchan = template.shape[0] if freq is None else len(freq)
+        if template.shape != (nchan, nbin):
+            raise ValueError(
+                f"Template portrait shape {template.shape} does not match "
+                f"data ({nchan} channels, {nbin} bins)."
+            )
+        return template.I
+    else:
+        return template.I
+
+TOA_RESULT_DTYPE = np.dtype([(name, np.float64) for name in ToaResult._fields])
+
+def _toa_block(data, weights, template, profile_rfft=None, template_rfft=None):
+    """
+    Calculate TOAs for a block of profiles of shape (..., nbin), skipping
+    profiles with zero weight, against templates broadcast against them.
+    Returns a structured array with dtype `TOA_RESULT_DTYPE`.
+    """
+    template = np.asarray(template)
+    if template_rfft is None:
+        template_rfft = scipy.fft.rfft(template)
+    mask = np.broadcast_to(np.asarray(weights) > 0, data.shape[:-1])
+    if template.ndim > 1:
+        # Select the template of each profile by its trailing indices (e.g.,
+        # the channel); a single template profile broadcasts as it is
+        index = np.nonzero(mask)[mask.ndim - (template.ndim - 1):]
+        template = template[index]
+        template_rfft = template_rfft[index]
+    if profile_rfft is not None:
+        profile_rfft = profile_rfft[mask]
+    result = toa_fourier_batch(template, data[mask], template_rfft=template_rfft,
+                               profile_rfft=profile_rfft)
+
+    out = np.full(data.shape[:-1], np.nan, dtype=TOA_RESULT_DTYPE)
+    for name in ToaResult._fields:
+        out[name][mask] = getattr(result, name)
+    return out
+
+def _toa_lazy_block(data, weights, template, shape, block_info=None):
+    # Select the weights and templates matching this block of a dask array
+    location = block_info[0]['array-location']
+    index = tuple(slice(start, stop) for start, stop in location[:-1])
+    weights = np.broadcast_to(weights, shape[:-1])[index]
+    if template.ndim > 1:
+        template = template[index[len(index) - (template.ndim - 1):]]
+    return _toa_block(data, weights, template)
+
+def make_toas(template, portrait, out=None):
+    """
+    Calculate TOAs (in bins) for each profile in `portrait`, which may be
+    a Portrait, an Observation, or an array of shape (..., nbin).
+    Returns arrays `toas`, `errs`, and `ampls`, with the shape of the data
+    without the phase axis.
+
+    The template may be a Profile, used for every channel, or a Portrait
+    or SplineModel, in which case each channel is correlated with its own
+    template profile. A SplineModel is evaluated once on the frequencies
+    of the data, which must then be a Portrait or Observation. Template
+    spectra are computed once and shared by all subintegrations.
+    If the data have weights, profiles with zero weight are not timed,
+    and their results are set to NaN. The spectrum of a Portrait or
+    Observation is reused if it has already been cached; otherwise, only
+    the profiles with nonzero weight are transformed.
+
+    If the data are a dask array (see `Observation.from_file()`), TOAs are
+    computed block by block as a dask task graph, using the currently
+    configured dask scheduler.
+
+    If `out` is given, it should be a structured array with fields 'toa',
+    'error', 'ampl', and 'snr' (such as the data of a `ToaTable`, reshaped
+    to match), with one row per profile. Results are written into it in place.
+    """
+    data = getattr(portrait, 'I', portrait)
+    if not is_lazy(data):
+        data = np.asarray(data)
+    freq = getattr(portrait, 'freq', None)
+    template_arr = template_portrait(template, freq, data.shape[-1])
+    weights = getattr(portrait, 'weights', None)
+    if weights is None:
+        weights = np.ones(data.shape[:-1])
+
+    if is_lazy(data):
+        result = data.map_blocks(
+            _toa_lazy_block, weights=weights, template=template_arr, shape=data.shape,
+            drop_axis=data.ndim - 1, dtype=TOA_RESULT_DTYPE,
+            meta=np.empty((0,)*(data.ndim - 1), dtype=TOA_RESULT_DTYPE),
+        ).compute()
+    else:
+        # Reuse a cached spectrum, but don't compute one for the whole cube:
+        # only the profiles with nonzero weight are transformed
+        profile_rfft = None
+        if hasattr(portrait, 'cached_spectrum'):
+            profile_rfft = portrait.cached_spectrum('I')
+        result = _toa_block(data, weights, template_arr, profile_rfft)
+
+    if out is None:
+        return result['toa'], result['error'], result['ampl']
+    for name in ToaResult._fields:
+        out[name] = result[name]
+    return out['toa'], out['error'], out['ampl']
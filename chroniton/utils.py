@@ -1,4 +1,22 @@
 import numpy as np
+import scipy.fft
+
+from . import kernels
+from .kernels import get_backend
+
+# Target number of elements in the temporary arrays of chunked computations
+CHUNK_ELEMENTS = 2**22
+
+def chunk_length(item_size, chunk_size=None):
+    """
+    Number of items to process at once in a chunked computation, where each
+    item needs temporary arrays of `item_size` elements, so that the
+    temporaries of a chunk hold about `CHUNK_ELEMENTS` elements in all.
+    An explicit `chunk_size` is returned unchanged.
+    """
+    if chunk_size is not None:
+        return chunk_size
+    return max(1, CHUNK_ELEMENTS//max(int(item_size), 1))
 
 def fft_roll(arr, shift):
     """
@@ -8,43 +26,127 @@ def fft_roll(arr, shift):
     numpy.roll() -- positive shift is toward the end of the array.
     This is the reverse of the convention used by pypulse.utils.fftshift().
     If the array has more than one axis, the last axis is shifted.
+    Single-precision input gives single-precision output.
     """
     n = arr.shape[-1]
     if not hasattr(shift, 'shape'):
         shift = np.array(shift)
     shift = shift[..., np.newaxis]
-    phase = -2j*np.pi*shift*np.fft.rfftfreq(n)
-    return np.fft.irfft(np.fft.rfft(arr)*np.exp(phase), n)
+    phase = -2j*np.pi*shift*scipy.fft.rfftfreq(n)
+    spectrum = scipy.fft.rfft(arr)
+    return scipy.fft.irfft(spectrum*np.exp(phase).astype(spectrum.dtype, copy=False), n)
 
-def fft_interp(arr, x):
+def fft_resample(arr, nbin, spectrum=None):
+    """
+    Resample an array to `nbin` bins along its last axis by truncating or
+    zero-padding its DFT, giving the same result as scipy.signal.resample()
+    for real input. If the spectrum (`scipy.fft.rfft(arr)`) has already
+    been computed, it can be passed as `spectrum`; it may have extra
+    leading axes (e.g., one per Stokes parameter) not present in `arr`.
+    """
+    if spectrum is None:
+        spectrum = scipy.fft.rfft(arr)
+    n = arr.shape[-1]
+    m = min(nbin, n)
+    resampled = np.zeros(spectrum.shape[:-1] + (nbin//2 + 1,), dtype=spectrum.dtype)
+    resampled[..., :m//2 + 1] = spectrum[..., :m//2 + 1]
+    if m % 2 == 0 and nbin != n:
+        # Split or merge the Nyquist term, as scipy.signal.resample() does
+        resampled[..., m//2] *= 2 if nbin < n else 0.5
+    out = scipy.fft.irfft(resampled, nbin)
+    out *= nbin/n
+    return out
+
+def _sample_points(arr, x):
+    """
+    Prepare sample locations for interpolation along the last axis of `arr`.
+    Returns `x` with at least one dimension, the shape of the output (the
+    leading axes of `arr` broadcast against the leading axes of `x`, plus
+    the last axis of `x`), and whether `x` was a scalar.
+    """
+    x = np.asarray(x)
+    scalar = (x.ndim == 0)
+    if scalar:
+        x = x[np.newaxis]
+    lead = np.broadcast_shapes(arr.shape[:-1], x.shape[:-1])
+    return x, lead + x.shape[-1:], scalar
+
+def fft_interp(arr, x, spectrum=None, chunk_size=None):
     """
     Interpolate the values in `arr` at the locations `x`, in bins.
     As with `fft_roll()`, this works by using the amplitudes and frequencies
     associated with the DFT of `arr` to define a continuous function.
+
+    Interpolation is along the last axis of `arr`. The last axis of `x`
+    indexes sample points, and any leading axes are broadcast against the
+    leading axes of `arr`, so a stack of profiles of shape (..., nbin) can
+    be evaluated at a common set of points of shape (m,) or at per-profile
+    points of shape (..., m). A scalar `x` gives one value per profile.
+
+    Parameters
+    ----------
+    arr: Array of values to interpolate. May be real or complex.
+    x: Locations (in bins) at which to evaluate the interpolant.
+    spectrum: DFT of `arr` along its last axis, if already computed
+              (`np.fft.rfft(arr)` for real `arr`, `np.fft.fft(arr)` otherwise).
+    chunk_size: Number of sample points to evaluate at once. By default,
+                this bounds memory use for large numbers of points (see
+                `chunk_length()`).
     """
     n = arr.shape[-1]
-    if not hasattr(x, 'shape'):
-        x = np.array(x)
-    phase = 2j*np.pi*x[..., np.newaxis]*np.fft.fftfreq(n)
-    return np.mean(np.fft.fft(arr)*np.exp(phase), axis=-1)[()]
+    x, out_shape, scalar = _sample_points(arr, x)
+    is_complex = np.iscomplexobj(arr)
+    if is_complex:
+        freqs = np.fft.fftfreq(n)
+        weights = np.ones(n)
+        if spectrum is None:
+            spectrum = np.fft.fft(arr)
+    else:
+        # Use the real-input DFT, counting each positive frequency twice
+        # (except DC, and Nyquist if n is even)
+        freqs = np.fft.rfftfreq(n)
+        weights = np.full(freqs.size, 2.0)
+        weights[0] = 1.0
+        if n % 2 == 0:
+            weights[-1] = 1.0
+        if spectrum is None:
+            spectrum = np.fft.rfft(arr)
+    coeffs = (spectrum*weights/n)[..., np.newaxis]
+
+    m = x.shape[-1]
+    chunk_size = chunk_length(freqs.size*int(np.prod(out_shape[:-1])), chunk_size)
+    out = np.empty(out_shape, dtype=np.result_type(spectrum) if is_complex else np.float64)
+    for start in range(0, m, chunk_size):
+        stop = min(start + chunk_size, m)
+        phase = 2j*np.pi*x[..., start:stop, np.newaxis]*freqs
+        vals = np.matmul(np.exp(phase), coeffs)[..., 0]
+        out[..., start:stop] = vals if is_complex else vals.real
+
+    if scalar:
+        out = out[..., 0]
+    return out[()]
 
 def lerp(arr, x):
     """
     Linearly interpolate the values in `arr` at the locations `x`, in bins.
     For locations `x` outside the original array, extrapolate the function
-    periodically.
+    periodically. Interpolation is along the last axis of `arr`, and `x`
+    is broadcast against `arr` in the same way as for `fft_interp()`.
     """
     n = arr.shape[-1]
-    if not hasattr(x, 'shape'):
-        x = np.array(x)
+    x, out_shape, scalar = _sample_points(arr, x)
     floor = np.floor(x)
     t = x - floor
     pre_idx = floor.astype(np.int64) % n
     post_idx = np.ceil(x).astype(np.int64) % n
-    pre_val = arr.take(pre_idx)
-    post_val = arr.take(post_idx)
+
+    arr = np.broadcast_to(arr, out_shape[:-1] + (n,))
+    pre_val = np.take_along_axis(arr, np.broadcast_to(pre_idx, out_shape), axis=-1)
+    post_val = np.take_along_axis(arr, np.broadcast_to(post_idx, out_shape), axis=-1)
     interp_val = (1-t)*pre_val + t*post_val
 
+    if scalar:
+        interp_val = interp_val[..., 0]
     return interp_val[()]
 
 def offpulse_window(profile, size):
@@ -52,29 +154,42 @@ def offpulse_window(profile, size):
     Find the off-pulse window of a given profile, defined as the
     segment of pulse phase of length `size` (in phase bins)
     minimizing the integral of the pulse profile.
+    If `profile` has more than one axis, each profile along the last
+    axis gets its own window.
     '''
-    bins = np.arange(len(profile))
-    lower = np.argmin(rolling_sum(profile, size))
-    upper = lower + size
-    return np.logical_and(lower <= bins, bins < upper)
+    n = profile.shape[-1]
+    bins = np.arange(n)
+    lower = np.argmin(rolling_sum(profile, size), axis=-1)[..., np.newaxis]
+    # rolling_sum()[i] covers bins i+1, ..., i+size (wrapping around the
+    # end of the profile), so the window starts one bin after its minimum
+    return (bins - lower - 1) % n < size
 
 def offpulse_rms(profile, size):
     '''
     Calculate the off-pulse RMS of a profile (a measure of noise level).
     This is the RMS of `profile` in the segment of length `size`
     (in phase bins) minimizing the integral of `profile`.
+    If `profile` has more than one axis, the RMS of each profile along
+    the last axis is returned.
     '''
     opw = offpulse_window(profile, size)
-    return np.sqrt(np.mean(profile[opw]**2))
+    if profile.ndim == 1:
+        return np.sqrt(np.mean(profile[opw]**2))
+    sumsq = np.sum(np.where(opw, profile**2, 0), axis=-1)
+    return np.sqrt(sumsq/np.sum(opw, axis=-1))
 
 def rolling_sum(arr, size):
     '''
     Calculate the sum of values in `arr` in a sliding window of length `size`,
     wrapping around at the end of the array.
+    If `arr` has more than one axis, the sum is along the last axis.
     '''
-    n = len(arr)
-    s = np.cumsum(arr)
-    return np.array([s[(i+size)%n]-s[i]+(i+size)//n*s[-1] for i in range(n)])
+    if arr.ndim == 1 and get_backend() == 'numba':
+        return kernels.rolling_sum(arr, size)
+    n = arr.shape[-1]
+    s = np.cumsum(arr, axis=-1)
+    i = np.arange(n)
+    return s[..., (i+size)%n] - s + (i+size)//n*s[..., -1:]
 
 def symmetrize_limits(data, vmin=None, vmax=None):
     '''
@@ -89,3 +204,10 @@ def symmetrize_limits(data, vmin=None, vmax=None):
         lim = min(lim, -vmin)
     vmin, vmax = -lim, lim
     return vmin, vmax
+
+def is_lazy(arr):
+    """
+    Check whether `arr` is a chunked lazy array (e.g., a dask array)
+    rather than an in-memory NumPy array.
+    """
+    return hasattr(arr, 'chunks') and hasattr(arr, 'map_blocks')
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from chroniton import kernels
+from chroniton.toas import toa_fourier, toa_fourier_batch
+from chroniton.utils import fft_roll, rolling_sum
+
+pytest.importorskip('numba')
+
+@pytest.fixture
+def backend():
+    # Run a function under a given backend, restoring the previous one afterwards
+    previous = kernels._backend
+    def run(name, func, *args, **kwargs):
+        kernels.set_backend(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            kernels._backend = previous
+    return run
+
+def simulated_profiles(nprof, nbin=512, seed=0):
+    rng = np.random.default_rng(seed)
+    phase = np.arange(nbin)/nbin
+    template = np.exp(-0.5*((phase - 0.5)/0.02)**2)
+    shifts = rng.uniform(-200, 200, nprof)
+    snr = rng.uniform(2, 200, nprof)
+    profiles = fft_roll(np.broadcast_to(template, (nprof, nbin)), shifts)
+    profiles += rng.standard_normal((nprof, nbin))*(np.sqrt(np.sum(template**2))/snr)[:, np.newaxis]
+    return template, profiles
+
+def test_toa_fourier(backend):
+    template, profiles = simulated_profiles(50)
+    for profile in profiles:
+        toa_numpy, err_numpy, _, _ = backend('numpy', toa_fourier, template, profile)
+        toa_numba, err_numba, _, _ = backend('numba', toa_fourier, template, profile)
+        assert abs(toa_numba - toa_numpy) < 1e-5
+        assert abs(toa_numba - toa_numpy) < 1e-4*err_numpy
+
+def test_toa_fourier_batch(backend):
+    template, profiles = simulated_profiles(500, seed=1)
+    result_numpy = backend('numpy', toa_fourier_batch, template, profiles)
+    result_numba = backend('numba', toa_fourier_batch, template, profiles)
+    np.testing.assert_allclose(result_numba.toa, result_numpy.toa, rtol=0, atol=1e-7)
+    np.testing.assert_allclose(result_numba.ampl, result_numpy.ampl, rtol=1e-9)
+    np.testing.assert_allclose(result_numba.error, result_numpy.error, rtol=1e-9)
+
+@pytest.mark.parametrize('size', [1, 7, 128, 511])
+def test_rolling_sum(backend, size):
+    arr = np.random.default_rng(2).standard_normal(512)
+    np.testing.assert_allclose(backend('numba', rolling_sum, arr, size),
+                               backend('numpy', rolling_sum, arr, size), rtol=0, atol=1e-9)
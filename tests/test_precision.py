@@ -0,0 +1,35 @@
+import numpy as np
+import astropy.units as u
+
+from chroniton import Observation, Profile
+from chroniton.simulate import Simulator
+from chroniton.toas import make_toas
+
+def test_float32_toas(tmp_path):
+    # Single-precision data should give the same TOAs as double precision,
+    # to well within their uncertainties (see `Observation.from_file()`)
+    nbin = 512
+    phase = np.arange(nbin)/nbin
+    template = Profile(np.exp(-0.5*((phase - 0.5)/0.02)**2))
+    freq = np.linspace(1200, 1600, 16)*u.MHz
+    rng = np.random.default_rng(0)
+    sim = Simulator(template, freq, nsub=8, pol_type='AA+BB', noise=0.05,
+                    toa_offsets=rng.uniform(-20, 20, (8, 16)), zapped=[3], seed=1)
+    filename = str(tmp_path/'sim.fits')
+    sim.write(filename)
+
+    obs32 = Observation.from_file(filename, dtype=np.float32)
+    obs64 = Observation.from_file(filename, dtype=np.float64)
+    assert obs32.I.dtype == np.float32
+    assert obs64.I.dtype == np.float64
+    toas32, errs32, ampls32 = make_toas(template, obs32)
+    toas64, errs64, ampls64 = make_toas(template, obs64)
+
+    timed = sim.weights > 0
+    assert np.all(np.isfinite(toas64[timed]))
+    np.testing.assert_allclose(toas32[timed], toas64[timed], rtol=0, atol=1e-6)
+    assert np.all(np.abs(toas32 - toas64)[timed] < 1e-5*errs64[timed])
+    np.testing.assert_allclose(ampls32[timed], ampls64[timed], rtol=1e-7)
+    np.testing.assert_allclose(errs32[timed], errs64[timed], rtol=1e-6)
+    # And both recover the injected offsets
+    assert np.all(np.abs(toas64 - sim.true_shifts)[timed] < 5*errs64[timed])